@@ -1,68 +1,79 @@
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import MessagesPlaceholder
-
-# from langchain import SerpAPIWrapper
-from langchain.agents import initialize_agent
-from langchain.agents import AgentType, AgentExecutor
-from langchain.tools import StructuredTool
+import langchain
 from langchain.chat_models import ChatOpenAI
 
+import asyncio
 from typing import List, Dict
 import panel as pn
-import param
 import pandas as pd
-import geopandas as gpd
 
-from modules.chat_utils import tools, map_mgr#, chat_box
+from modules.llm_cache import LLM_CACHE
+from modules.session_utils import SESSIONS, SessionBusy
+from modules.trace_utils import diagnostics_panel, span
 # from modules.rasterize_plots import s2_hv_plot, create_rgb_viewer
 
 pd.options.plotting.backend = 'holoviews'
 
 pn.extension('floatpanel')
 
+# Replay answers and function calls already seen instead of calling the LLM again
+langchain.llm_cache = LLM_CACHE
+
+llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo-0613")
+
+# Own MapManager, tools, memory and agent for this browser session
+session = SESSIONS.get(llm)
+
 chat_box = pn.widgets.ChatBox(ascending=True)
+progress = pn.indicators.LoadingSpinner(value=False, width=25, height=25, align="center")
+cancel_button = pn.widgets.Button(name="Cancel", button_type="warning", disabled=True)
+
 
-def chat(user_messages: List[Dict[str, str]]) -> None:
+def update_progress():
+    busy = session.outstanding > 0
+    progress.value = busy
+    cancel_button.disabled = not busy
+
+
+async def chat(user_messages: List[Dict[str, str]]) -> None:
     # user_messages = [{"You": "Your input"}, {"AI": "A response"}, ...]
     user_message = user_messages[-1]
     input = user_message.get("You")
     if input is None:
         return
-    text = agent.run(input=input)
-    
-    if map_mgr.media is not None:
-        media = map_mgr.media
-        chat_box.append({"SatGPT": media})
-        map_mgr.media = None
 
-    chat_box.append({"SatGPT": text})
+    progress.value = True
+    cancel_button.disabled = False
+    try:
+        with session.tracer.activate(), span("chat", message_chars=len(input)):
+            text, media = await session.run(input)
+    except asyncio.CancelledError:
+        chat_box.append({"SatGPT": "Cancelled."})
+    except SessionBusy:
+        chat_box.append({"SatGPT": "Still working on your previous requests, please wait or cancel."})
+    except Exception as exc:
+        chat_box.append({"SatGPT": f"Something went wrong: {exc}"})
+    else:
+        if media is not None:
+            chat_box.append({"SatGPT": media})
+        chat_box.append({"SatGPT": text})
+    update_progress()
 
-pn.bind(chat, user_messages=chat_box, watch=True)
 
-llm = ChatOpenAI(temperature=0, model="gpt-3.5-turbo-0613")
+def cancel(event):
+    session.cancel()
 
-agent_kwargs = {
-    "extra_prompt_messages": [MessagesPlaceholder(variable_name="memory")],
-}
-memory = ConversationBufferMemory(memory_key="memory", return_messages=True)
 
+pn.bind(chat, user_messages=chat_box, watch=True)
+cancel_button.on_click(cancel)
 
-agent = initialize_agent(
-    tools, 
-    llm, 
-    agent=AgentType.OPENAI_FUNCTIONS, 
-    verbose=True,
-    agent_kwargs=agent_kwargs, 
-    memory=memory
-    )
-component = pn.Column(chat_box, height=800)
+component = pn.Column(chat_box, pn.Row(progress, cancel_button), height=800)
 
 template = pn.template.FastListTemplate(
     # site="Awesome Panel",
     title="SatGPT - Panel Demo App",
     logo="https://panel.holoviz.org/_static/logo_stacked.png",
     main=[component],
+    sidebar=[pn.Card(diagnostics_panel(session.tracer), title="Diagnostics", collapsed=True)],
 )
 
-template.servable()
\ No newline at end of file
+template.servable()
@@ -0,0 +1,189 @@
+"""
+Offline benchmarks of the raster and search pipeline hot paths.
+
+Raster stages run on synthetic dask datacubes (uint16 DN, Sentinel-2 bands),
+search stages replay the items captured in tmp/items.json. No network is used.
+
+    python -m benchmarks.bench_pipeline                       # default sizes
+    python -m benchmarks.bench_pipeline --sizes 1024x1,10240x50
+    python -m benchmarks.bench_pipeline --save benchmarks/baseline.json
+    python -m benchmarks.bench_pipeline --compare benchmarks/baseline.json
+
+Each stage reports wall time, peak traced memory (tracemalloc) and throughput;
+--compare exits non-zero if a stage got slower (or hungrier) than the baseline
+by more than --tolerance.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import dask
+import dask.array as da
+import geopandas as gpd
+import numpy as np
+import xarray as xr
+from modules.cmap_utils import get_cmap_options
+from modules.datacube_utils import RGB_BANDS, clip_stage, index_stage
+from modules.footprint_utils import footprint_layer
+from modules.image_processing import s2_contrast_stretch, s2_dn_to_reflectance
+from modules.image_statistics import get_sketch, plot_spindex_kde
+from modules.item_store import ItemStore
+from modules.metadata_utils import summarize_metadata
+from modules.spyndex_utils import get_index_props
+
+ITEMS_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "tmp", "items.json")
+DEFAULT_SIZES = "1024x1,2048x5,4096x10"
+FULL_SIZES = "1024x1,2048x5,4096x10,10240x50"
+CUBE_BANDS = RGB_BANDS + ["nir"]
+
+
+def synthetic_cube(size, dates, chunk=2048, seed=0):
+    """Lazy (band, time, y, x) uint16 DN cube of size x size pixels, like stac_load(...).to_array("band")"""
+
+    data = da.random.RandomState(seed).randint(
+        0, 10000, size=(len(CUBE_BANDS), dates, size, size), chunks=(1, 1, chunk, chunk), dtype="uint16"
+    )
+    return xr.DataArray(
+        data,
+        dims=("band", "time", "y", "x"),
+        coords={
+            "band": CUBE_BANDS,
+            "time": np.datetime64("2023-01-01") + np.arange(dates).astype("timedelta64[D]"),
+            "y": np.arange(size)[::-1] * 10.0,
+            "x": np.arange(size) * 10.0,
+        },
+    )
+
+
+def measure(fn, units):
+    """Run fn once, returning wall time (s), peak traced memory (MB) and units/s"""
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"wall_s": wall, "peak_mb": peak / 2**20, "throughput": units / wall if wall else float("inf")}
+
+
+def raster_stages(size, dates):
+    """(name, fn, pixels) of the raster stages for one cube size"""
+
+    cube = synthetic_cube(size, dates)
+    reflectance = s2_dn_to_reflectance(cube)
+    one_date = reflectance.isel(time=0)
+    ndvi_props = get_index_props("NDVI", "sentinel-2-l2a")
+    ndvi = index_stage(one_date, ndvi_props)
+    pixels = size * size
+
+    def sketch():
+        # Fresh arrays each run, the sketch cache must not hide the scan
+        get_sketch(index_stage(s2_dn_to_reflectance(synthetic_cube(size, 1, seed=1)).isel(time=0), ndvi_props))
+
+    return [
+        ("s2_dn_to_reflectance", lambda: reflectance.sum().compute(), pixels * dates * len(CUBE_BANDS)),
+        ("s2_contrast_stretch", lambda: s2_contrast_stretch(one_date.sel(band=RGB_BANDS)).sum().compute(), pixels * 3),
+        ("compute_index", lambda: index_stage(reflectance, ndvi_props).sum().compute(), pixels * dates),
+        ("histogram_sketch", sketch, pixels),
+        ("clip_stage", lambda: clip_stage(ndvi, (2.5, 97.5)).sum().compute(), pixels),
+        ("plot_spindex_kde", lambda: plot_spindex_kde("NDVI", get_sketch(ndvi), value_range=(-1, 1)), 1),
+    ]
+
+
+def search_stages(features):
+    """(name, fn, items) of the search side stages on the replayed items"""
+
+    store = ItemStore(features, key="bench")
+    gdf = store.gdf
+    bbox = tuple(gdf.total_bounds)
+    n = len(features)
+
+    return [
+        ("GeoDataFrame.from_features", lambda: gpd.GeoDataFrame.from_features(features), n),
+        ("ItemStore", lambda: ItemStore(features).gdf, n),
+        ("ItemStore.query", lambda: store.query(bbox=bbox, order_by="eo:cloud_cover"), n),
+        ("summarize_metadata", lambda: summarize_metadata(gdf, "weekly"), n),
+        ("footprint_layer", lambda: footprint_layer(gdf), n),
+        ("get_cmap_options", get_cmap_options, 1),
+    ]
+
+
+def run(sizes, items_path=ITEMS_PATH, repeat=1):
+    """Results keyed by 'stage[size]', keeping the best of repeat runs"""
+
+    results = {}
+
+    def record(key, fn, units):
+        runs = [measure(fn, units) for _ in range(repeat)]
+        best = min(runs, key=lambda r: r["wall_s"])
+        results[key] = best
+        print(f"{key:<45} {best['wall_s']:9.3f} s {best['peak_mb']:9.1f} MB {best['throughput']:14.1f} /s")
+
+    with open(items_path) as f:
+        features = json.load(f)["features"]
+    for name, fn, units in search_stages(features):
+        record(f"{name}[{len(features)} items]", fn, units)
+
+    for size, dates in sizes:
+        for name, fn, units in raster_stages(size, dates):
+            record(f"{name}[{size}x{size}x{dates}]", fn, units)
+
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Stages whose wall time or peak memory exceed the baseline by more than tolerance"""
+
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric in ["wall_s", "peak_mb"]:
+            if result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{key} {metric}: {base[metric]:.3f} -> {result[metric]:.3f}")
+    return regressions
+
+
+def parse_sizes(sizes):
+    return [tuple(int(v) for v in s.split("x")) for s in sizes.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="comma separated PIXELSxDATES cubes")
+    parser.add_argument("--full", action="store_true", help=f"use {FULL_SIZES}")
+    parser.add_argument("--items", default=ITEMS_PATH, help="captured STAC search (FeatureCollection)")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--save", help="write the results as a baseline JSON")
+    parser.add_argument("--compare", help="baseline JSON to check the results against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    # Threaded scheduler like the app
+    dask.config.set(scheduler="threads")
+    results = run(parse_sizes(FULL_SIZES if args.full else args.sizes), args.items, args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"python": platform.python_version(), "machine": platform.machine(), "results": results},
+                f,
+                indent=2,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
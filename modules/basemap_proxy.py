@@ -0,0 +1,229 @@
+"""
+Caching proxy for basemap tiles (OpenStreetMap, NASA GIBS):
+
+    /basemap/osm/{z}/{x}/{y}.png
+    /basemap/gibs/{z}/{x}/{y}.jpg?layer=MODIS_Aqua_CorrectedReflectance_TrueColor&time=2023-06-09
+
+Load with `panel serve app.py --plugins modules.basemap_proxy`
+(or `pn.serve(..., extra_patterns=ROUTES)`). Set SATGPT_TILES_OFFLINE=1
+to only serve tiles that are already cached.
+"""
+
+import asyncio
+import math
+import os
+import re
+import string
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from tornado.web import HTTPError, RequestHandler
+from modules.cache_utils import CACHE_DIR, DiskCache
+from modules.trace_utils import count, span
+
+UPSTREAMS = {
+    "osm": "https://tile.openstreetmap.org/{z}/{x}/{y}.png",
+    "gibs": (
+        "https://gibs.earthdata.nasa.gov/wmts/epsg3857/best/"
+        "{layer}/default/{time}/GoogleMapsCompatible_Level9/{z}/{y}/{x}.jpg"
+    ),
+}
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg"}
+
+
+class DiskTileCache(DiskCache):
+    """Basemap tiles on disk, see DiskCache"""
+
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, "basemap_cache"), max_bytes=2**30):
+        super().__init__(cache_dir, max_bytes)
+
+
+def bbox_tiles(bbox, zoom):
+    """XYZ tiles (x, y) covering a lon/lat bbox at zoom"""
+
+    minx, miny, maxx, maxy = bbox
+    n = 2**zoom
+
+    def tile_x(lon):
+        return min(n - 1, max(0, int((lon + 180) / 360 * n)))
+
+    def tile_y(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+
+    return [
+        (x, y)
+        for x in range(tile_x(minx), tile_x(maxx) + 1)
+        for y in range(tile_y(maxy), tile_y(miny) + 1)
+    ]
+
+
+def bbox_zoom(bbox, frame_size=500):
+    """Zoom level at which bbox fits a frame_size pixels map"""
+
+    minx, miny, maxx, maxy = bbox
+    span = max(maxx - minx, (maxy - miny) * 2, 1e-6)
+    return max(0, min(19, int(math.log2(360 * frame_size / (256 * span)))))
+
+
+class BasemapProxy:
+    """
+    Fetches basemap tiles from the upstream servers (url templates with
+    {z}/{x}/{y} and query parameters as placeholders) through a disk cache.
+    Concurrent requests for the same tile share one upstream request, and in
+    offline mode only cached tiles are served.
+    """
+
+    def __init__(self, upstreams=UPSTREAMS, cache=None, offline=False, max_workers=8):
+        self.upstreams = dict(upstreams)
+        self.cache = cache if cache is not None else DiskTileCache()
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="basemap")
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+        self._http = requests.Session()
+        self._http.headers["User-Agent"] = "SatGPT basemap proxy"
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._http.mount("https://", adapter)
+        self._http.mount("http://", adapter)
+
+    def check_params(self, source, params):
+        """Keep only the query parameters the upstream template uses, rejecting unsafe values"""
+
+        names = {f for _, f, _, _ in string.Formatter().parse(self.upstreams[source]) if f}
+        missing = names - {"z", "x", "y"} - set(params)
+        if missing:
+            raise ValueError(f"missing parameters {sorted(missing)} for {source}")
+        params = {k: v for k, v in params.items() if k in names}
+        for value in params.values():
+            # Values end up in the upstream url and the cache path
+            if not re.fullmatch(r"[\w-]+(\.[\w-]+)*", value):
+                raise ValueError(f"invalid parameter value {value!r}")
+        return params
+
+    def tile_path(self, source, z, x, y, **params):
+        """Cache path of a tile, params (e.g. GIBS layer/time) are part of it"""
+
+        ext = self.upstreams[source].rsplit(".", 1)[-1]
+        prefix = "/".join(str(params[k]) for k in sorted(params))
+        return os.path.join(source, prefix, str(z), str(x), f"{y}.{ext}")
+
+    def get(self, source, z, x, y, **params):
+        """concurrent.futures.Future of the tile bytes, None if unavailable (upstream 404, offline miss)"""
+
+        path = self.tile_path(source, z, x, y, **params)
+        data = self.cache.get(path)
+        with self._lock:
+            if data is not None:
+                self.hits += 1
+                count("cache.basemap.hit")
+                future = Future()
+                future.set_result(data)
+                return future
+            future = self._fetching.get(path)
+            if future is not None:
+                return future
+            self.misses += 1
+            count("cache.basemap.miss")
+            if self.offline:
+                future = Future()
+                future.set_result(None)
+                return future
+            future = self._fetching[path] = self._pool.submit(self._fetch, source, path, z, x, y, params)
+        future.add_done_callback(lambda f: self._done(path))
+        return future
+
+    def _fetch(self, source, path, z, x, y, params):
+        url = self.upstreams[source].format(z=z, x=x, y=y, **params)
+        with span("basemap.fetch", source=source, z=z) as s:
+            resp = self._http.get(url, timeout=30)
+            s.attrs["status"] = resp.status_code
+        if resp.status_code in (400, 404):
+            return None
+        resp.raise_for_status()
+        self.cache.set(path, resp.content)
+        return resp.content
+
+    def _done(self, path):
+        with self._lock:
+            self._fetching.pop(path, None)
+
+    def prefetch(self, source, bbox, zoom=None, depth=1, max_tiles=256, **params):
+        """
+        Fetch the tiles covering bbox (lon/lat) at zoom (the zoom fitting bbox by default)
+        and the depth neighbouring zoom levels in the background, at most max_tiles
+        """
+
+        if isinstance(bbox, str):
+            bbox = tuple(map(float, bbox.split(",")))
+        if self.offline:
+            return []
+        zoom = bbox_zoom(bbox) if zoom is None else zoom
+
+        futures = []
+        for z in range(max(0, zoom - depth), zoom + depth + 1):
+            for x, y in bbox_tiles(bbox, z):
+                if len(futures) >= max_tiles:
+                    return futures
+                if self.tile_path(source, z, x, y, **params) not in self.cache:
+                    futures.append(self.get(source, z, x, y, **params))
+        return futures
+
+    def url(self, source, ext=None, **params):
+        """Proxy url template ({Z}/{X}/{Y} placeholders) of a source, e.g. for hv.Tiles"""
+
+        ext = ext or self.upstreams[source].rsplit(".", 1)[-1]
+        query = f"?{urlencode(params)}" if params else ""
+        return f"/basemap/{source}/" + "{Z}/{X}/{Y}" + f".{ext}{query}"
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "cached_tiles": len(self.cache._files),
+            "cached_bytes": self.cache.nbytes,
+        }
+
+
+# Shared by all sessions
+BASEMAP_PROXY = BasemapProxy(offline=os.environ.get("SATGPT_TILES_OFFLINE", "0") == "1")
+
+
+class BasemapHandler(RequestHandler):
+    """GET /basemap/{source}/{z}/{x}/{y}.{ext}"""
+
+    def initialize(self, proxy=None):
+        self.proxy = proxy or BASEMAP_PROXY
+
+    async def get(self, source, z, x, y, ext):
+        if source not in self.proxy.upstreams:
+            raise HTTPError(404, f"unknown basemap {source}")
+        try:
+            params = self.proxy.check_params(
+                source, {k: self.get_argument(k) for k in self.request.arguments}
+            )
+        except ValueError as exc:
+            raise HTTPError(400, str(exc))
+
+        try:
+            data = await asyncio.wrap_future(self.proxy.get(source, int(z), int(x), int(y), **params))
+        except requests.RequestException as exc:
+            raise HTTPError(502, str(exc))
+        if data is None:
+            raise HTTPError(404)
+
+        self.set_header("Content-Type", CONTENT_TYPES.get(ext, "application/octet-stream"))
+        self.set_header("Cache-Control", "public, max-age=86400")
+        self.write(data)
+
+
+# Picked up by `panel serve --plugins modules.basemap_proxy`
+ROUTES = [
+    (r"/basemap/([^/]+)/(\d+)/(\d+)/(\d+)\.(\w+)", BasemapHandler),
+]
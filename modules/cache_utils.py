@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from modules.trace_utils import count, span
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tmp")
+
+
+def normalize_search_key(url, collection, bbox, dtime):
+    """
+    Normalize the STAC search arguments so that equivalent searches
+    (e.g. same bbox with different spacing/precision) share a cache key
+    """
+
+    url = (url or "").strip().rstrip("/")
+    if isinstance(bbox, str):
+        bbox = bbox.split(",")
+    bbox = tuple(round(float(b), 5) for b in bbox)
+    dtime = "/".join(d.strip() for d in str(dtime).split("/"))
+
+    return (url, collection.strip().lower(), bbox, dtime)
+
+
+def key_digest(key):
+    """Short stable id of a (normalized) key, e.g. to name an item set"""
+
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+
+class DiskCache:
+    """
+    Files (bytes, keyed by their path relative to cache_dir) evicted least recently
+    used first once they take more than max_bytes. Access order survives restarts (mtime).
+    """
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._files = OrderedDict()  # relative path -> size
+        self._lock = threading.Lock()
+
+        found = []
+        for root, _, names in os.walk(cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                found.append((stat.st_mtime, os.path.relpath(path, cache_dir), stat.st_size))
+        for _, path, size in sorted(found):
+            self._files[path] = size
+            self.nbytes += size
+
+    def get(self, path):
+        with self._lock:
+            if path not in self._files:
+                return None
+            self._files.move_to_end(path)
+        full = os.path.join(self.cache_dir, path)
+        try:
+            with open(full, "rb") as f:
+                data = f.read()
+            os.utime(full)
+        except OSError:
+            return None
+        return data
+
+    def set(self, path, data):
+        full = os.path.join(self.cache_dir, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        tmp = f"{full}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, full)
+
+        with self._lock:
+            self.nbytes += len(data) - self._files.pop(path, 0)
+            self._files[path] = len(data)
+            while self.nbytes > self.max_bytes and len(self._files) > 1:
+                evicted, size = self._files.popitem(last=False)
+                self.nbytes -= size
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except OSError:
+                    pass
+
+    def remove(self, path):
+        with self._lock:
+            size = self._files.pop(path, None)
+            if size is None:
+                return
+            self.nbytes -= size
+        try:
+            os.remove(os.path.join(self.cache_dir, path))
+        except OSError:
+            pass
+
+    def clear(self):
+        with self._lock:
+            paths = list(self._files)
+        for path in paths:
+            self.remove(path)
+
+    def __contains__(self, path):
+        with self._lock:
+            return path in self._files
+
+
+class StacSearchCache:
+    """
+    Two tier (memory LRU + JSON on disk) cache for STAC search results with TTL expiry.
+    The disk tier is a DiskCache bounded by max_bytes.
+    """
+
+    def __init__(self, max_items=32, ttl=3600, cache_dir=os.path.join(CACHE_DIR, "stac_cache"), max_bytes=2**28):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._disk = DiskCache(cache_dir, max_bytes)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return f"{key_digest(key)}.json"
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """Return the cached value for key or None if missing/expired"""
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._memory[key]
+
+        path = self._path(key)
+        data = self._disk.get(path)
+        if data is not None:
+            try:
+                entry = json.loads(data)
+            except ValueError:
+                entry = None
+            if entry is not None and not self._expired(entry["created"]):
+                with self._lock:
+                    self._put_memory(key, entry["created"], entry["value"])
+                    self.hits += 1
+                    self.disk_hits += 1
+                return entry["value"]
+            self._disk.remove(path)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """Store value in both tiers"""
+
+        created = time.time()
+        with self._lock:
+            self._put_memory(key, created, value)
+
+        entry = {"created": created, "key": key, "value": value}
+        self._disk.set(self._path(key), json.dumps(entry).encode())
+
+    def _put_memory(self, key, created, value):
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        self._disk.clear()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ArrayCache:
+    """
+    LRU cache of computed (in-memory) intermediate arrays, evicted by total bytes
+    so that the shared memory budget holds across sessions.
+    Concurrent requests for a key that is still computing wait for that computation.
+    """
+
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = OrderedDict()
+        self._computing = {}  # key -> Future of the value
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, fn):
+        """Return the cached array for key, or compute fn() (pulling dask data into memory) and cache it"""
+
+        if key is None:
+            return fn()
+
+        with self._lock:
+            value = self._arrays.get(key)
+            if value is not None:
+                self._arrays.move_to_end(key)
+                self.hits += 1
+                count("cache.array.hit")
+                return value
+            future = self._computing.get(key)
+            owner = future is None
+            if owner:
+                future = self._computing[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not owner:
+            count("cache.array.wait")
+            return future.result()
+        count("cache.array.miss")
+
+        try:
+            with span("compute", stage=str(key[-1])) as s:
+                value = fn()
+                if hasattr(value, "compute"):
+                    value = value.compute()
+                nbytes = int(getattr(value, "nbytes", 0))
+                s.attrs["nbytes"] = nbytes
+        except BaseException as exc:
+            with self._lock:
+                self._computing.pop(key, None)
+            future.set_exception(exc)
+            raise
+
+        with self._lock:
+            self._computing.pop(key, None)
+            # Larger than the budget: never cached, would evict everything else
+            if nbytes <= self.max_bytes and key not in self._arrays:
+                self._arrays[key] = value
+                self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._arrays.popitem(last=False)
+                self.nbytes -= int(getattr(evicted, "nbytes", 0))
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._arrays.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._arrays),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# Shared by all sessions
+SEARCH_CACHE = StacSearchCache()
+ARRAY_CACHE = ArrayCache()
@@ -1,41 +1,187 @@
-from datetime import datetime
+import asyncio
+import os
+import threading
+import uuid
+from datetime import timedelta
+from functools import partial
 import holoviews as hv
 import hvplot.xarray
 from typing import Optional
 import panel as pn
 import param
-from pystac_client.client import Client
-from odc.stac import stac_load
-import geopandas as gpd
-import pystac
 from langchain.tools import StructuredTool
-from modules.spyndex_utils import BAND_MAPPING, get_indices, get_index_props
-from modules.datacube_utils import plot_rgb, get_index_pane
+from modules.spyndex_utils import get_indices, get_index_props, compute_indices
+from modules.datacube_utils import (
+    RGB_BANDS,
+    plot_rgb,
+    get_index_pane,
+    select_date,
+    rgb_stage,
+    index_stage,
+    clip_stage,
+    render_rgb,
+    render_index,
+    render_tiles,
+    plot_tiles,
+)
+from modules.image_statistics import plot_spindex_kde, get_sketch
 from modules.cmap_utils import get_cmap_options, get_cmap_plot
-from modules.image_processing import s2_dn_to_reflectance, landsat_dn_to_reflectance
+from modules.image_processing import COMPOSITE_METHODS, dn_to_reflectance, mask_clouds
+from modules.cache_utils import SEARCH_CACHE, ARRAY_CACHE, normalize_search_key, key_digest
+from modules.search_utils import StreamingSearch, AsyncStreamingSearch
+from modules.item_store import ItemStore
+from modules.trace_utils import count, traced
+from modules.footprint_utils import footprint_layer
+from modules.metadata_utils import get_summary
+from modules.tile_server import register_source, tile_url
+from modules.basemap_proxy import BASEMAP_PROXY
+from modules.export_utils import (
+    EXPORT_DIR,
+    CUBE_FORMATS,
+    TIMELAPSE_FORMATS,
+    export_cog,
+    export_zarr,
+    export_timelapse,
+)
+from modules.loader_utils import (
+    DateCubeLoader,
+    load_cube,
+    empty_cube,
+    plan_bands,
+    pick_resolution,
+    native_resolution,
+    bbox_from_3857,
+)
+
+class ToolCancelled(Exception):
+    """Raised inside a tool's worker thread once its turn has been cancelled"""
+
+
+class ViewerState:
+    """
+    What a viewer is built on: the search's items, collection and bbox, the overview
+    resolution and the per-date loader. The viewer's closures only read this, so an
+    open viewer keeps showing its own search whatever the manager runs next.
+    """
+
+    def __init__(self, store, collection, bbox, resolution):
+        if isinstance(bbox, str):
+            bbox = tuple(map(float, bbox.split(",")))
+        self.store = store
+        self.collection = collection
+        self.bbox = tuple(bbox)
+        self.resolution = resolution
+        self.loader = None  # DateCubeLoader of the overview, set by the viewer
+        # Tile server item set: per viewer, sessions running the same search don't share it
+        self.item_set = f"{store.key}-{uuid.uuid4().hex[:8]}"
+
+    def load(self, time, resolution, bands=None, bbox=None):
+        """
+        Lazily load the datacube for the items acquired on a single date
+        (all bands over the search bbox by default).
+        Tiles of the same pass are mosaicked into one time slice per solar day.
+        An all-NaN cube is returned where no item covers the bbox on that date.
+        """
+
+        bbox = bbox or self.bbox
+
+        # Kept as DN (uint16), reflectance is applied lazily by dn_to_reflectance
+        raw_data = load_cube(self.store, self.collection, time, bands=bands, bbox=bbox, resolution=resolution)
+        if raw_data is None:
+            return empty_cube(self.collection, bbox, resolution, time, bands=bands)
+        return raw_data
+
+    def refine(self, time, comp_index, x_range, y_range, mask_cl=False, composite="None", composite_days=None):
+        """Load the visible extent at a finer resolution when zoomed in, else None"""
+
+        if x_range is None or y_range is None or composite != "None":
+            return None
+        bbox = bbox_from_3857(x_range, y_range)
+        resolution = pick_resolution(bbox, self.collection)
+        if resolution >= self.resolution:
+            return None
+        bands = plan_bands(self.collection, comp_index, mask_cl)
+        raw_data = load_cube(self.store, self.collection, time, bands=bands, bbox=bbox, resolution=resolution)
+        if raw_data is None:
+            # Nothing acquired in view on that date, keep the overview
+            return None
+        raw_data = raw_data.persist()
+        if mask_cl:
+            raw_data = mask_clouds(raw_data, self.collection)
+        return select_date(dn_to_reflectance(raw_data, self.collection), time)
+
+    def tile(self, time, layer, bbox, geobox, mask_cl=False, composite="None", composite_days=None):
+        """
+        A layer on the grid of one map tile (geobox), reading only the tile's pixels,
+        or None (composites and dates without items in the tile use the overview)
+        """
+
+        if composite != "None":
+            return None
+        bands = plan_bands(self.collection, layer, mask_cl)
+        raw_data = load_cube(self.store, self.collection, time, bands=bands, bbox=bbox, geobox=geobox)
+        if raw_data is None:
+            return None
+        if mask_cl:
+            raw_data = mask_clouds(raw_data, self.collection)
+        data = select_date(dn_to_reflectance(raw_data, self.collection), time)
+        if layer == "RGB":
+            return data.sel(band=RGB_BANDS)
+        return index_stage(data, get_index_props(layer, self.collection))
+
+    def date_stage(self, time_event, comp_index, mask_cl=False, composite="None", composite_days=10):
+        """
+        Load + select date stages: reflectance of the bands comp_index needs on that date,
+        cloud masked and/or composited over the composite_days window ending on it
+        """
+
+        # Only the selected date and the bands it needs are loaded, adjacent dates are prefetched
+        bands = plan_bands(self.collection, comp_index, mask_cl)
+        if composite == "None":
+            raw_data = self.loader.get(time_event, bands)
+        else:
+            # The window is not persisted, it is reduced chunk by chunk
+            start = time_event - timedelta(days=composite_days - 1)
+            raw_data = self.load((start, time_event), self.resolution, bands=bands)
+
+        if mask_cl:
+            raw_data = mask_clouds(raw_data, self.collection)
+
+        # Resident cubes stay DN, reflectance is computed lazily per rendered chunk
+        data = dn_to_reflectance(raw_data, self.collection)
+
+        cloud_scores = self.store.cloud_scores(data.time.values) if composite == "best" else None
+        return select_date(data, time_event, composite=composite, cloud_scores=cloud_scores)
+
+    def cache_key(self, time_event, **selection):
+        # Intermediate arrays are memoized per (item set, resolution, date, mask/composite, ...)
+        return (self.store.key, self.resolution, time_event) + tuple(sorted(selection.items()))
+
 
 class MapManager(param.Parameterized):
-    gdf = param.DataFrame(
-        # gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
-        # columns=['geometry']
-    )
+    store = param.ClassSelector(class_=ItemStore)  # items of the current search
 
     ## STAC search
     bbox = param.String()  # (=seattle)
     # toi = # (now minus 1-2 months)
     stac_url = "https://earth-search.aws.element84.com/v1/"
     # collection = # (~satellites)
-    items_dict = param.Dict({})
+    _search = None  # in-flight StreamingSearch, if any
 
     ## Basic view
     media = None
     data = None
+    max_resident_dates = param.Integer(5, bounds=(1, None), precedence=-1)
+    resolution = None  # overview resolution of the open viewer (EPSG:3857 units)
+    _loader = None  # DateCubeLoader of the open viewer
     mask_clouds = param.Boolean()
-    mask_clouds.precedence = -1  # Hide for now
+    use_tiles = param.Boolean(True, precedence=-1, doc="Show images as tile server layers (see tile_server)")
+    composite = param.Selector(["None"] + COMPOSITE_METHODS, doc="Cloud-free temporal composite")
+    composite_days = param.Integer(10, bounds=(1, 90), doc="Days in the composite window")
     mask = None
     # available_dates =
     # selected_date(s) =
-    tile_url = param.String("https://tile.openstreetmap.org/{Z}/{X}/{Y}.png")
+    tile_url = param.String(BASEMAP_PROXY.url("osm"))
     # map_bounds =
     # clip_range = param.Range((5,95))
     # cmap =  # (if not RGB)
@@ -45,10 +191,46 @@ class MapManager(param.Parameterized):
     index = 'NDVI' # TODO: could make this a param Selector
 
     ## Resampling
-    # max_resolution =
+    # max_resolution =  (see loader_utils.pick_resolution)
     # resample_period =
     # zonal_url =  # point to e.g. geojson gist?
 
+    def __init__(self, **params):
+        super().__init__(**params)
+        self._cancelled = threading.Event()  # set by cancel, cleared at the start of each turn
+
+    def cancel(self):
+        """Ask the running tool (and any search still streaming) to stop"""
+
+        self._cancelled.set()
+        if self._search is not None:
+            self._search.cancel()
+
+    def check_cancelled(self):
+        """Called by the tools between steps (dates, files) to stop early once cancelled"""
+
+        if self._cancelled.is_set():
+            raise ToolCancelled()
+
+    async def _in_thread(self, fn, *args):
+        """
+        Run a blocking tool body on a worker thread. When the awaiting task is
+        cancelled, the worker is asked to stop and is waited for before the
+        cancellation propagates, so that the session's next turn never overlaps it.
+        """
+
+        future = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self._cancelled.set()
+            while not future.done():
+                try:
+                    await asyncio.wait([future])
+                except asyncio.CancelledError:
+                    pass
+            raise
+
     def stac_search(
         self,
         bbox: str,
@@ -58,30 +240,85 @@ class MapManager(param.Parameterized):
     ) -> str:
         """Perform a STAC search for Sentinel (sentinel-2-l2a) or Landsat (landsat-c2-l2) L2 images."""
 
-        self.bbox = bbox  # TODO: change to tuple?
-        self.collection = collection
+        matched, search = self._prepare_search(bbox, dtime, collection, url, StreamingSearch)
+        if search is None:
+            return {
+                "count": matched,
+            }
 
-        client = Client.open(url)
-        result = client.search(collections=[collection], bbox=bbox, datetime=dtime)
-        items_dict = result.get_all_items_as_dict()
+        self._search = search.start()
 
-        self.items_dict = items_dict
-        self.gdf = gpd.GeoDataFrame.from_features(items_dict)
+        # Return as soon as there is something to show, the rest streams into the store.
+        # Raises if the catalog failed (or timed out) before returning anything.
+        search.first_page_result()
 
         return {
-            "count": result.matched(),
+            "count": search.count,
+            "loaded": len(self.store),
         }
 
+    async def astac_search(
+        self,
+        bbox: str,
+        dtime: str,
+        collection: str = "sentinel-2-l2a",
+        url: Optional[str] = "https://earth-search.aws.element84.com/v1/",
+    ) -> str:
+        """Async variant of stac_search, pages are fetched on the event loop through a shared aiohttp pool."""
+
+        matched, search = self._prepare_search(bbox, dtime, collection, url, AsyncStreamingSearch)
+        if search is None:
+            return {
+                "count": matched,
+            }
+
+        self._search = await search.start()
+        await search.wait_first_page()
+
+        return {
+            "count": search.count,
+            "loaded": len(self.store),
+        }
+
+    def _prepare_search(self, bbox, dtime, collection, url, search_cls):
+        """
+        Point the manager at a new search: either a cache hit (matched count, None)
+        or a fresh store and a not yet started search_cls instance (None, search)
+        """
+
+        self.bbox = bbox  # TODO: change to tuple?
+        self.collection = collection
+        self.dtime = dtime
+
+        # Repeated searches (same normalized bbox/dtime/collection) skip the catalog
+        key = normalize_search_key(url, collection, bbox, dtime)
+        cached = SEARCH_CACHE.get(key)
+        count("cache.search.hit" if cached is not None else "cache.search.miss")
+        if cached is not None:
+            self._search = None
+            self.store = ItemStore(cached["items"]["features"], key=key_digest(key))
+            return cached["count"], None
+
+        store = ItemStore(key=key_digest(key))
+        search = search_cls(
+            url,
+            collection,
+            bbox,
+            dtime,
+            on_page=store.append,
+            on_done=lambda items: SEARCH_CACHE.set(key, {"count": search.count, "items": items}),
+        )
+        self.store = store
+        return None, search
+
     def view_footprints(
         self,
     ):
         """Load Sentinel & Landsat STAC item footprints to a map. Not for images. DO NOT use for Aqua/Terra/MODIS."""
 
-        m = (
-            self.gdf.loc[:, ["geometry"]]
-            .set_crs("epsg:4326")
-            .explore(tiles="CartoDB positron")
-        )
+        # Distinct tiles simplified to the map's zoom, or a count grid for large searches
+        footprints = footprint_layer(self.store.gdf)
+        m = footprints.explore(column="count", cmap="Blues", tiles="CartoDB positron")
 
         self.media = pn.pane.plot.Folium(m, height=400)
         return "Map is loaded to chat. Return nothing but a text confirmation to let the user know."
@@ -91,35 +328,60 @@ class MapManager(param.Parameterized):
         field: str = "eo:cloud_cover",
     ):
         """Plot any field from the current STAC items, e.g. cloud cover. No images, just STAC metadata fields."""
-        dates = [
-            ds.split("T")[0] for ds in self.gdf.loc[:, ["datetime"]].values.flatten()
-        ]
-        dts = [datetime.strptime(d, "%Y-%m-%d") for d in dates]
-        self.gdf.loc[:, ["date"]] = dts
-
         self.media = pn.panel(
-                    self.gdf.loc[:, ["date", field]].set_index("date").plot()
+                    self.store.gdf.loc[:, ["date", field]].set_index("date").plot()
                 )
 
         return "Plot is loaded to chat. Return nothing other than 'Plotted!' to the user."
 
+    def summarize_metadata(
+        self,
+        period: str = "monthly",
+        field: str = "eo:cloud_cover",
+        max_cloud_cover: Optional[float] = None,
+        platform: Optional[str] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+    ) -> str:
+        """
+        Summarize the current STAC items per time period ('daily', 'weekly' or 'monthly'):
+        item count, mean/min/max of a numeric field (e.g. eo:cloud_cover) and items per platform.
+        Optional filters: max_cloud_cover, platform, start/end dates (YYYY-MM-DD).
+        Use to answer questions like which month had the clearest imagery.
+        """
+
+        table = get_summary(
+            self.store,
+            period,
+            field,
+            max_cloud_cover=max_cloud_cover,
+            platform=platform,
+            start=start,
+            end=end,
+        )
+        self.media = pn.pane.DataFrame(table, sizing_mode="stretch_width")
+
+        return table.round(2).to_csv()
+
     def set_basemap(
         self, datestring: str = "2023-06-09", source: Optional[str] = "Aqua"
     ):
         """
-        Sets basemap with Modis (source = 'Aqua' or 'Terra') world coverage by date.
-        This tool does NOT require a prior STAC search. Currently only supports RGB views, no spectral indices.
+        Sets basemap with Modis (source = 'Aqua' or 'Terra') world coverage by date and shows it.
+        The image viewer draws on top of it. This tool does NOT require a prior STAC search.
         """
         # Valid:
         # https://gibs.earthdata.nasa.gov/wmts/epsg4326/best/wmts.cgi
         # ?Service=WMTS&Request=GetTile&Version=1.0.0&layer=MODIS_Terra_CorrectedReflectance_TrueColor&tilematrixset=250m
         # &TileMatrix=6&TileCol=36&TileRow=13&TIME=2012-07-09&style=default&Format=image%2Fjpeg
 
-        tileMatrixSet = "GoogleMapsCompatible_Level9"
+        # Served and cached by the basemap proxy, which builds the GIBS WMTS url
+        # (GoogleMapsCompatible_Level9 tile matrix set, see basemap_proxy.UPSTREAMS)
         layer = f"MODIS_{source}_CorrectedReflectance_TrueColor"
-        base_url = "https://gibs.earthdata.nasa.gov/wmts/epsg3857/best/"
-        tile_path = f"{layer}/default/{datestring}/{tileMatrixSet}/" + "{Z}/{Y}/{X}.jpg"
-        self.tile_url = base_url + tile_path
+        self.tile_url = BASEMAP_PROXY.url("gibs", layer=layer, time=datestring)
+        if self.bbox:
+            BASEMAP_PROXY.prefetch("gibs", self.bbox, layer=layer, time=datestring)
+        self.media = pn.pane.HoloViews(render_tiles(self.tile_url))
         return "Basemap is set. Return nothing but a text confirmation to let the user know."
 
     def show_datacube(self):
@@ -130,72 +392,248 @@ class MapManager(param.Parameterized):
 
         return "Images are loaded to chat. Return nothing other than 'Done!' to the user."
 
-    def _load_data(self, time, resolution):
+    def export_data(
+        self,
+        layer: str = "RGB",
+        fmt: str = "cog",
+        resolution: Optional[float] = None,
+    ) -> str:
+        """
+        Save the images of the current items to disk: the RGB bands, a spectral index (e.g. NDVI)
+        or several comma separated indices (e.g. 'NDVI,NDWI,EVI', one band each) of every date
+        as GeoTIFF (fmt='cog') or Zarr (fmt='zarr'), or an RGB time-lapse (fmt='gif' or 'mp4').
+        resolution is the pixel size in meters, native (10 m Sentinel-2, 30 m Landsat) by default.
+        """
+
+        if self._search is not None:
+            self._search.wait()
+        fmt = fmt.lower()
+        if fmt not in CUBE_FORMATS + TIMELAPSE_FORMATS:
+            raise ValueError(f"fmt must be one of {CUBE_FORMATS + TIMELAPSE_FORMATS}")
+
+        layer = "RGB" if fmt in TIMELAPSE_FORMATS else layer.strip('\"')
+        layers = [name.strip() for name in layer.split(",") if name.strip()]
+        if "RGB" in layers and len(layers) > 1:
+            raise ValueError("RGB can't be exported together with indices")
+        layer = "-".join(layers)
+        bands = list(dict.fromkeys(b for name in layers for b in plan_bands(self.collection, name)))
+        if fmt in TIMELAPSE_FORMATS and resolution is None:
+            # Frames are for screens, not analysis
+            resolution = pick_resolution(self.bbox, self.collection)
+        else:
+            resolution = native_resolution(self.bbox, self.collection, resolution)
+        view = ViewerState(self.store, self.collection, self.bbox, resolution)
+        dates = sorted(self.store.dates())
+        out_dir = os.path.join(EXPORT_DIR, self.store.key)
+        os.makedirs(out_dir, exist_ok=True)
+
+        def layer_data(time):
+            # Called once per file (or frame), the place to stop a cancelled export
+            self.check_cancelled()
+            # Lazy: pixels are read chunk by chunk while writing
+            raw_data = view.load(time, resolution, bands=bands)
+            data = dn_to_reflectance(raw_data, self.collection)
+            if layer == "RGB":
+                return data.sel(band=RGB_BANDS)
+            if len(layers) == 1:
+                return index_stage(data, get_index_props(layer, self.collection))
+            # The indices share their band reads and are written in one pass, one band each
+            return compute_indices(data, layers, self.collection).to_array("band")
+
+        if fmt in TIMELAPSE_FORMATS:
+            path = os.path.join(out_dir, f"timelapse.{fmt}")
+            export_timelapse(lambda d: select_date(layer_data(d), d), dates, path)
+            self.media = pn.pane.GIF(path) if fmt == "gif" else pn.pane.Video(path)
+            paths = [path]
+        elif fmt == "zarr":
+            path = os.path.join(out_dir, f"{layer}.zarr")
+            paths = [export_zarr(layer_data((dates[0], dates[-1])), path, name=layer)]
+        else:
+            # One file per date, so that only one date is loaded at a time
+            paths = [
+                export_cog(select_date(layer_data(d), d), os.path.join(out_dir, f"{layer}_{d.isoformat()}.tif"))
+                for d in dates
+            ]
+            self.media = pn.Column(*[pn.widgets.FileDownload(file=p) for p in paths])
 
-        print(f"loading data for {str(time)}")
-        items = pystac.ItemCollection(self.items_dict["features"])
+        return f"Saved {len(paths)} file(s) to {out_dir}. Tell the user where to find them."
 
-        bands = list(BAND_MAPPING[self.collection].values())
+    # Async variants of the tools: the work is blocking (rasterio reads, plotting),
+    # so it runs on a thread while the event loop keeps serving other sessions
 
-        raw_data = stac_load(
-            items,
-            bbox=tuple(map(float, self.bbox.split(','))),
-            bands=bands,
-            resolution=resolution,
-            chunks={'time': 1, 'x': 2048, 'y': 2048},
-            crs="EPSG:3857"
-            ).to_array(dim="band")
+    async def aview_footprints(self):
+        """Async variant of view_footprints."""
+        return await self._in_thread(self.view_footprints)
 
-        if self.collection == 'sentinel-2-l2a':
-            data = s2_dn_to_reflectance(raw_data)
-            # if self.mask_clouds:
-                # mask the clouds
+    async def aplot_metadata(self, field: str = "eo:cloud_cover"):
+        """Async variant of plot_metadata."""
+        return await self._in_thread(self.plot_metadata, field)
 
-        if self.collection == 'landsat-c2-l2':
-            data = landsat_dn_to_reflectance(raw_data)
-            # if self.mask_clouds:
-                # mask the clouds
+    async def asummarize_metadata(
+        self,
+        period: str = "monthly",
+        field: str = "eo:cloud_cover",
+        max_cloud_cover: Optional[float] = None,
+        platform: Optional[str] = None,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+    ) -> str:
+        """Async variant of summarize_metadata."""
+        return await self._in_thread(
+            self.summarize_metadata, period, field, max_cloud_cover, platform, start, end
+        )
 
-        else:
-            data = raw_data
+    async def aset_basemap(self, datestring: str = "2023-06-09", source: Optional[str] = "Aqua"):
+        """Async variant of set_basemap."""
+        return self.set_basemap(datestring, source)
 
-        self.data = data
+    async def aexport_data(self, layer: str = "RGB", fmt: str = "cog", resolution: Optional[float] = None) -> str:
+        """Async variant of export_data."""
+        return await self._in_thread(self.export_data, layer, fmt, resolution)
+
+    async def ashow_datacube(self):
+        """Async variant of show_datacube."""
+        return await self._in_thread(self.show_datacube)
 
     def _viewer(self):
-        def switch_layer(raw_data, collection, comp_index, time_event, clip_range, mask_cl, cmap):
+        """
+        Image viewer built as a staged pipeline:
+        load -> select date -> compute index -> clip -> colorize -> render.
+        Every stage result is memoized in ARRAY_CACHE and each view only binds the
+        widgets it depends on, so e.g. a clip change skips the index computation
+        and a colormap change only re-colorizes the pixels in the browser.
+        """
+
+        if self._search is not None:
+            self._search.wait()
+
+        # Everything below reads this viewer's own search, never the manager's current one
+        time_date = self.store.dates()
+        view = ViewerState(self.store, self.collection, self.bbox, pick_resolution(self.bbox, self.collection))
+        # initializes the per-date loader at the coarsest resolution that fills the frame
+        view.loader = DateCubeLoader(
+            partial(view.load, resolution=view.resolution),
+            dates=time_date,
+            max_resident=self.max_resident_dates,
+        )
+        self.resolution, self._loader = view.resolution, view.loader
+
+        # selection = mask_cl, composite, composite_days
+        def rgb_view(time_event, clip_range, x_range=None, y_range=None, **selection):
+            key = view.cache_key(time_event, **selection) + ("RGB", tuple(clip_range))
+            rgb_data = ARRAY_CACHE.get_or_compute(
+                key, lambda: rgb_stage(view.date_stage(time_event, "RGB", **selection), clip_range)
+            )
+
+            finer = view.refine(time_event, "RGB", x_range, y_range, **selection)
+            if finer is not None:
+                rgb_data = rgb_stage(finer, clip_range)
+
+            return render_rgb(rgb_data)
+
+        def index_data(props, time_event, **selection):
+            key = view.cache_key(time_event, **selection) + (props["short_name"],)
+            return ARRAY_CACHE.get_or_compute(
+                key, lambda: index_stage(view.date_stage(time_event, props["short_name"], **selection), props)
+            )
+
+        def clipped_data(props, time_event, clip_range, **selection):
+            key = view.cache_key(time_event, **selection) + (props["short_name"], tuple(clip_range))
+            return ARRAY_CACHE.get_or_compute(
+                key, lambda: clip_stage(index_data(props, time_event, **selection), clip_range)
+            )
+
+        def index_view(props, time_event, clip_range, x_range=None, y_range=None, **selection):
+            clipped = clipped_data(props, time_event, clip_range, **selection)
+
+            finer = view.refine(time_event, props["short_name"], x_range, y_range, **selection)
+            if finer is not None:
+                # Same clip thresholds as the overview so that colors stay consistent
+                overview = index_data(props, time_event, **selection)
+                clipped = clip_stage(index_stage(finer, props), clip_range, overview)
+
+            return render_index(clipped)
+
+        # Warm the basemap around the search while the first date loads
+        BASEMAP_PROXY.prefetch("osm", view.bbox)
+
+        def layer_array(time_event, layer, **selection):
+            # In-memory overview of a layer, cut into tiles by the tile server
+            if layer == "RGB":
+                key = view.cache_key(time_event, **selection) + ("RGB bands",)
+                return ARRAY_CACHE.get_or_compute(
+                    key, lambda: view.date_stage(time_event, "RGB", **selection).sel(band=RGB_BANDS)
+                )
+            return index_data(get_index_props(layer, view.collection), time_event, **selection)
+
+        # Tile layers: the tile server renders (and caches) only the visible tiles, from the
+        # same persisted cube and memoized stages as the views above, or, zoomed in
+        # deeper than the overview, from the tile's own pixels (view.tile)
+        item_set = register_source(
+            view.item_set, layer_array, view.bbox, view.resolution, view.tile,
+            layers=["RGB"] + get_indices(view.collection),
+        )
+
+        def rgb_tiles(time_event, clip_range, **selection):
+            return render_tiles(tile_url(item_set, time_event, "RGB", clip_range, **selection))
+
+        def index_tiles(props, time_event, clip_range, cmap, **selection):
+            url = tile_url(item_set, time_event, props["short_name"], clip_range, cmap=cmap, **selection)
+            return render_tiles(url)
+
+        def kde_view(props, time_event, clip_range, **selection):
+            # Same histogram as the clip stage, only the smoothing is redone
+            sketch = get_sketch(index_data(props, time_event, **selection))
+            return plot_spindex_kde(props["short_name"], sketch, value_range=sketch.percentiles(clip_range))
+
+        @traced("viewer.switch_layer")
+        def switch_layer(comp_index):
             """
-            # TODO: Simplify, Add more composites
-            A function that plots the selected composite or index.
+            # TODO: Add more composites
+            A function that builds the pane of the selected composite or index.
+            Only runs when the composite/index changes, the date, clip range
+            and mask only re-run the stages of the (memoized) views.
             """
 
+            # OSM unless set_basemap picked a GIBS layer
+            basemap = hv.Tiles(self.tile_url, name="Basemap")
             if comp_index == "RGB":
-                map_pane = plot_rgb(raw_data, time_event, clip_range)
+                if self.use_tiles:
+                    view = pn.bind(rgb_tiles, time_event=time_select, clip_range=range_select, **selection)
+                    map_pane = plot_tiles(view, basemap)
+                else:
+                    view = pn.bind(rgb_view, time_event=time_select, clip_range=range_select, **selection)
+                    map_pane = plot_rgb(view, basemap)
                 cmap_select.disabled = True
                 cmap_view.disabled = True
-                range_select.disabled = False
             else:
                 self.index = comp_index.strip('\"')
-                metadata = get_index_props(self.index, collection)
-
-                map_pane = get_index_pane(raw_data, time_event, clip_range, metadata, cmap)
+                metadata = get_index_props(self.index, view.collection)
+
+                kde = pn.bind(kde_view, metadata, time_event=time_select, clip_range=range_select, **selection)
+                if self.use_tiles:
+                    view = pn.bind(
+                        index_tiles, metadata, time_event=time_select, clip_range=range_select,
+                        cmap=cmap_select, **selection
+                    )
+                    map_pane = get_index_pane(view, kde, metadata, basemap=basemap)
+                else:
+                    view = pn.bind(index_view, metadata, time_event=time_select, clip_range=range_select, **selection)
+                    map_pane = get_index_pane(view, kde, metadata, cmap_select, basemap=basemap)
                 cmap_select.disabled = False
                 cmap_view.disabled = False
-                range_select.disabled = True
-
-            print("finished plotting")
-
-            # load metadata
 
             return map_pane
 
-        items = pystac.ItemCollection(self.items_dict["features"])
         mask_select = self.param.mask_clouds
         # clip_select = self.param.clip_range
+        selection = dict(
+            mask_cl=mask_select,
+            composite=self.param.composite,
+            composite_days=self.param.composite_days,
+        )
 
-        # Time variable
-        time_var = [i.datetime for i in items]
-        time_date = [t.date() for t in time_var]
-
+        # Time variable (newest first)
         time_select = pn.widgets.DatePicker(
             name="Date",
             value=time_date[0],
@@ -206,7 +644,7 @@ class MapManager(param.Parameterized):
         )
 
         # TODO: Planning to add more composites
-        comp_index = {"Composites": ["RGB"], "Indices": get_indices(self.collection)}
+        comp_index = {"Composites": ["RGB"], "Indices": get_indices(view.collection)}
         comp_index_select = pn.widgets.Select(name="Composites/Indices", groups=comp_index, value="RGB")
 
         # TODO: Attach to map_mgr.clip_range, could update when switching to index based on min/ max values
@@ -224,22 +662,7 @@ class MapManager(param.Parameterized):
         cmap_select.disabled = True
         cmap_view.disabled = True
 
-        # initializes the data
-        self._load_data(
-            time=time_date[0],
-            resolution=None,
-        )
-
-        viewer_bind = pn.bind(
-            switch_layer,
-            raw_data=self.data,
-            collection=self.collection, # TODO: remove from plot func, eventually
-            comp_index=comp_index_select,
-            time_event=time_select,
-            clip_range=range_select,
-            mask_cl=mask_select,
-            cmap=cmap_select,
-        )
+        viewer_bind = pn.bind(switch_layer, comp_index=comp_index_select)
 
         wbox = pn.WidgetBox(
             '',
@@ -247,6 +670,8 @@ class MapManager(param.Parameterized):
             comp_index_select,
             range_select,
             mask_select,
+            self.param.composite,
+            self.param.composite_days,
             cmap_select,
             cmap_view,
             )
@@ -254,20 +679,40 @@ class MapManager(param.Parameterized):
         return pn.Row(wbox, viewer_bind)
 
 
+def _tool(fn, coroutine):
+    """StructuredTool of a MapManager method, every call traced as a 'tool.<name>' span"""
+
+    name = f"tool.{fn.__name__}"
+    return StructuredTool.from_function(traced(name)(fn), coroutine=traced(name)(coroutine))
+
+
+def build_tools(map_mgr):
+    """Wrap the methods of a MapManager as the agent's structured tools"""
+
+    # tools == a wrapped method above, with its async variant for agent.arun
+    search_tool = _tool(map_mgr.stac_search, coroutine=map_mgr.astac_search)
+    gribs_tool = _tool(map_mgr.set_basemap, coroutine=map_mgr.aset_basemap)
+    datacube_tool = _tool(map_mgr.show_datacube, coroutine=map_mgr.ashow_datacube)
+    plot_tool = _tool(map_mgr.plot_metadata, coroutine=map_mgr.aplot_metadata)
+    export_tool = _tool(map_mgr.export_data, coroutine=map_mgr.aexport_data)
+    summary_tool = _tool(
+        map_mgr.summarize_metadata, coroutine=map_mgr.asummarize_metadata
+    )
+    map_tool = _tool(map_mgr.view_footprints, coroutine=map_mgr.aview_footprints)
+
+    return [
+        search_tool,
+        map_tool,
+        gribs_tool,
+        plot_tool,
+        summary_tool,
+        datacube_tool,
+        export_tool,
+    ]
+
+
+# Module level instance for notebooks/debugging only, the app creates one per session
 map_mgr = MapManager()
 
 # define tools
-# tools == a wrapped method above
-search_tool = StructuredTool.from_function(map_mgr.stac_search)
-gribs_tool = StructuredTool.from_function(map_mgr.set_basemap)
-datacube_tool = StructuredTool.from_function(map_mgr.show_datacube)
-plot_tool = StructuredTool.from_function(map_mgr.plot_metadata)
-map_tool = StructuredTool.from_function(map_mgr.view_footprints)
-
-tools = [
-    search_tool,
-    map_tool,
-    # gribs_tool, # not working yet
-    plot_tool,
-    datacube_tool,
-]
+tools = build_tools(map_mgr)
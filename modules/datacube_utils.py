@@ -1,54 +1,97 @@
-import datetime
 import holoviews as hv
 import panel as pn
 import numpy as np
 from bokeh.models import HoverTool, WheelZoomTool
 import hvplot.xarray  # noqa
-from rasterio.session import AWSSession
 from holoviews.operation.datashader import rasterize
-from modules.image_processing import s2_contrast_stretch, s2_dn_to_reflectance, mask_clouds
-from modules.spyndex_utils import compute_index, get_index_props, get_index_metadata
-from modules.image_statistics import plot_spindex_kde
+from modules.image_processing import s2_contrast_stretch, temporal_composite
+from modules.spyndex_utils import compute_index, get_index_metadata
+from modules.image_statistics import get_sketch
+from modules.basemap_proxy import BASEMAP_PROXY
+from modules.trace_utils import traced
 
 hv.extension("bokeh")
 
 rasterize.expand = False
 
 RGB_BANDS = ["red", "green", "blue"]
-OSM_TILES = hv.element.tiles.OSM()
-
-
-def plot_rgb(raw_data, time_event, clip_range):
-    def hook(plot, element):
-        """
-        Custom hook for disabling x/y tick lines/labels
-        """
-        plot.state.xaxis.major_tick_line_color = None
-        plot.state.xaxis.minor_tick_line_color = None
-        plot.state.xaxis.major_label_text_font_size = "0pt"
-        plot.state.yaxis.major_tick_line_color = None
-        plot.state.yaxis.minor_tick_line_color = None
-        plot.state.yaxis.major_label_text_font_size = "0pt"
-
-        # Disable zoom on axis
-        for tool in plot.state.toolbar.tools:
-            if isinstance(tool, WheelZoomTool):
-                tool.zoom_on_axis = False
-                break
-
-    # TODO: Merge goes here if using
-    
-    rgb_data = raw_data.sel(time=time_event, method="nearest")
-    rgb_data = rgb_data.sel(band=RGB_BANDS)
+# Through the caching proxy (see basemap_proxy) instead of straight from OSM
+OSM_TILES = hv.Tiles(BASEMAP_PROXY.url("osm"), name="OSM")
+
+# Render stage pipeline used by the viewer:
+#   load (DateCubeLoader) -> select date -> compute index -> clip -> colorize -> render
+# Each stage below is a plain function of its own inputs so that the viewer can
+# memoize it and re-run only the stages whose inputs changed.
+
+
+def hook(plot, element):
+    """
+    Custom hook for disabling x/y tick lines/labels
+    """
+    plot.state.xaxis.major_tick_line_color = None
+    plot.state.xaxis.minor_tick_line_color = None
+    plot.state.xaxis.major_label_text_font_size = "0pt"
+    plot.state.yaxis.major_tick_line_color = None
+    plot.state.yaxis.minor_tick_line_color = None
+    plot.state.yaxis.major_label_text_font_size = "0pt"
+
+    # Disable zoom on axis
+    for tool in plot.state.toolbar.tools:
+        if isinstance(tool, WheelZoomTool):
+            tool.zoom_on_axis = False
+            break
+
+
+def select_date(raw_data, time_event, composite="None", cloud_scores=None):
+    """
+    Select stage: the slice of the cube nearest to the selected date, or the
+    cloud-free temporal composite of a cube loaded over a date window
+    """
+
+    if composite != "None":
+        return temporal_composite(raw_data, composite, cloud_scores)
+    return raw_data.sel(time=time_event, method="nearest")
+
+
+def rgb_stage(sel_data, clip_range):
+    """RGB stage: contrast stretched red/green/blue bands"""
+
+    rgb_data = sel_data.sel(band=RGB_BANDS)
 
     # # Contrast stretching
-    rgb_data = s2_contrast_stretch(rgb_data, clip_range)
+    return s2_contrast_stretch(rgb_data, clip_range)
 
-    rgb_plot = rgb_data.hvplot.rgb(
+
+@traced("index")
+def index_stage(sel_data, index_props):
+    """Index stage: the spectral index computed from the bands it needs"""
+
+    sel_data = sel_data.sel(band=index_props["stac_bands"])
+    return compute_index(sel_data, index_props).rename(index_props["short_name"])
+
+
+def clip_stage(index_data, clip_range, sketch_data=None):
+    """
+    Clip stage: drop index values outside the clip percentiles.
+    The percentiles come from the (cached) histogram of sketch_data, which
+    defaults to index_data; zoomed-in views pass the overview to keep colors stable.
+    """
+
+    sketch_data = index_data if sketch_data is None else sketch_data
+    pct_max, pct_min = get_sketch(sketch_data).percentiles(clip_range)
+
+    index_data = index_data.where(index_data < pct_min, np.nan)
+    return index_data.where(index_data > pct_max, np.nan)
+
+
+@traced("render.rgb")
+def render_rgb(rgb_data):
+    """Render stage for the RGB composite (data is already at screen resolution)"""
+
+    return rgb_data.hvplot.rgb(
         title="",
         x="x",
         y="y",
-        rasterize=True,
         bands='band',
         frame_width=500,
         frame_height=500,
@@ -56,80 +99,21 @@ def plot_rgb(raw_data, time_event, clip_range):
         yaxis=None,
         hover=False
         ).opts(hooks=[hook])
-    return OSM_TILES * rgb_plot
 
 
-def get_index_pane(raw_data, time_event, clip_range, metadata, cmap):
-    """
-    A function that plots the selected Sentinel-2 spectral index.
-    """
+@traced("render.index")
+def render_index(index_data):
+    """Render stage for a spectral index, colorized client side (see get_index_pane)"""
 
-    def hook(plot, element):
-        """
-        Custom hook for disabling x/y tick lines/labels
-        """
-        plot.state.xaxis.major_tick_line_color = None
-        plot.state.xaxis.minor_tick_line_color = None
-        plot.state.xaxis.major_label_text_font_size = "0pt"
-        plot.state.yaxis.major_tick_line_color = None
-        plot.state.yaxis.minor_tick_line_color = None
-        plot.state.yaxis.major_label_text_font_size = "0pt"
-
-        # Disable zoom on axis
-        for tool in plot.state.toolbar.tools:
-            if isinstance(tool, WheelZoomTool):
-                tool.zoom_on_axis = False
-                break
-
-    # Get index information 
-    index_props = metadata
-
-    # Get the name of the selected spectral index
-    index_name = index_props["short_name"]
-
-    # Define a custom Hover tool for the image
     spindex_hover = HoverTool(
-        tooltips=[(f"{index_name}", "@image")]
+        tooltips=[(f"{index_data.name or 'Index'}", "@image")]
     )
 
-    print(f"loading data & generating {index_name} plot for {str(time_event)}")
-
-    print("loading delayed data")
-
-    index_bands = index_props["stac_bands"]
-
-    sel_data = raw_data.sel(time=time_event, method="nearest")
-
-    # # TODO: Merge goes here if using
-    # start_date = datetime.datetime.strptime(time_event, "%m/%d/%y")
-    # end_date = date_1 + datetime.timedelta(days=10)
-    # sel_data = raw_data.sel(time=slice(start_date,end_date))
-
-    # # spatial merge
-    # sel_data = merge_arrays(
-    #     dataarrays=[sel_data.sel(time=d).transpose('band', 'y', 'x') for d in sel_data.coords['time'].values]
-    #     )
-
-    sel_data = sel_data.sel(band=index_bands)
-
-    # Get index parameters for spyndex
-    # TODO: Could move to _load_data()/ .data if fast enough over whole daterange?
-    # Good for e.g. saving off a datacube with indices after viewing.
-    index_data = compute_index(sel_data, index_props)
-
-    pct_min = index_data.quantile(clip_range[1]/100)
-    pct_max = index_data.quantile(clip_range[0]/100)
-    index_data = index_data.where(index_data < pct_min, np.nan)
-    index_data = index_data.where(index_data > pct_max, np.nan)
-
-    # Plot the computed spectral index
-    index_plot = index_data.hvplot.image(
+    return index_data.hvplot.image(
         title="",
         x="x",
         y="y",
-        rasterize=True,
         colorbar=False,
-        cmap=cmap,
         cnorm="eq_hist",
         frame_width=500,
         frame_height=500,
@@ -138,12 +122,47 @@ def get_index_pane(raw_data, time_event, clip_range, metadata, cmap):
         tools=[spindex_hover],
         ).opts(hooks=[hook])
 
-    lyr_plot = OSM_TILES * index_plot.redim.nodata(value=0)
 
-    meta_pane = get_index_metadata(index_props)
+def plot_rgb(rgb_view, basemap=OSM_TILES):
+    """
+    Map of the RGB composite. rgb_view(x_range, y_range) returns the rendered
+    element and is re-run only when its own inputs change (date, clip range, zoom).
+    """
+
+    rgb_plot = hv.DynamicMap(rgb_view, streams=[hv.streams.RangeXY()])
+    return basemap * rgb_plot
+
+
+@traced("render.tiles")
+def render_tiles(url):
+    """Render stage for a tile server layer (see tile_server), the browser fetches the visible tiles"""
+
+    return hv.Tiles(url).opts(frame_width=500, frame_height=500, xaxis=None, yaxis=None, hooks=[hook])
+
+
+def plot_tiles(tiles_view, basemap=OSM_TILES):
+    """Map of a tile layer, tiles_view() returns render_tiles of the current selection's url"""
+
+    return basemap * hv.DynamicMap(tiles_view)
+
+
+def get_index_pane(index_view, kde_view, metadata, cmap=None, basemap=OSM_TILES):
+    """
+    A function that plots the selected Sentinel-2 spectral index.
+    index_view(x_range, y_range) returns the rendered element and kde_view the density plot;
+    the colormap is applied client side so changing it never recomputes the index.
+    Without cmap, index_view returns a tile layer, colorized by the tile server.
+    """
+
+    if cmap is None:
+        lyr_plot = plot_tiles(index_view, basemap)
+    else:
+        index_plot = hv.DynamicMap(index_view, streams=[hv.streams.RangeXY()])
+        index_plot = index_plot.apply.opts(cmap=cmap)
+        lyr_plot = basemap * index_plot.redim.nodata(value=0)
 
-    kde_plot = plot_spindex_kde(index_name, index_data)
+    meta_pane = get_index_metadata(metadata)
 
-    index_pane = pn.Tabs(("Map", lyr_plot), ("Density plot", kde_plot), ("Metadata", meta_pane))
+    index_pane = pn.Tabs(("Map", lyr_plot), ("Density plot", kde_view), ("Metadata", meta_pane))
 
     return index_pane
@@ -0,0 +1,65 @@
+import os
+import threading
+import imageio.v2 as imageio
+import rasterio.shutil
+import rioxarray  # noqa
+from modules.cache_utils import CACHE_DIR
+from modules.image_processing import s2_contrast_stretch, s2_image_to_uint8
+
+EXPORT_DIR = os.path.join(CACHE_DIR, "exports")
+
+# Formats of the export tool: datacubes and time-lapses
+CUBE_FORMATS = ["cog", "zarr"]
+TIMELAPSE_FORMATS = ["gif", "mp4"]
+
+
+def export_cog(data, path, blocksize=512):
+    """
+    Write a (band, y, x) or (y, x) array as a Cloud Optimized GeoTIFF.
+    Dask chunks are written in parallel into a tiled GeoTIFF (windowed writes),
+    which GDAL then copies block by block into the COG layout.
+    """
+
+    tmp_path = f"{path}.tmp.tif"
+    data.rio.write_crs(data.rio.crs or "EPSG:3857").rio.to_raster(
+        tmp_path,
+        tiled=True,
+        blockxsize=blocksize,
+        blockysize=blocksize,
+        compress="deflate",
+        windowed=True,
+        lock=threading.Lock(),
+        compute=True,
+    )
+    rasterio.shutil.copy(tmp_path, path, driver="COG", compress="deflate", blocksize=blocksize)
+    os.remove(tmp_path)
+    return path
+
+
+def export_zarr(data, path, name="data"):
+    """Write an array to a Zarr store, chunk by chunk (the dask chunks)"""
+
+    data = data.drop_vars("spatial_ref", errors="ignore")
+    data.to_dataset(name=data.name or name).to_zarr(path, mode="w", compute=True)
+    return path
+
+
+def export_timelapse(frame_fn, dates, path, fps=2):
+    """
+    Write a GIF/MP4 time-lapse, one date at a time so that only one date is loaded.
+    frame_fn(date) returns the (band, y, x) RGB reflectance of a date, or None to skip it.
+    """
+
+    # MP4 (needs imageio-ffmpeg) streams frames to ffmpeg, the GIF encoder keeps the uint8 frames
+    if path.endswith(".gif"):
+        options = {"duration": 1000 / fps, "loop": 0}
+    else:
+        options = {"fps": fps}
+    with imageio.get_writer(path, mode="I", **options) as writer:
+        for date in dates:
+            rgb_data = frame_fn(date)
+            if rgb_data is None:
+                continue
+            frame = s2_image_to_uint8(s2_contrast_stretch(rgb_data).fillna(0))
+            writer.append_data(frame.transpose("y", "x", "band").values)
+    return path
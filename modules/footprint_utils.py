@@ -0,0 +1,86 @@
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+from shapely.geometry import box
+
+# Fields identifying the tile an item covers, in order of preference
+TILE_FIELDS = ["grid:code", "s2:mgrs_tile", "landsat:wrs_path_row"]
+
+
+def tile_key(gdf):
+    """Key grouping items that cover the same tile: the tile id if known, else the exact geometry"""
+
+    for field in TILE_FIELDS:
+        if field in gdf and gdf[field].notna().all():
+            return gdf[field].astype(str)
+    return pd.Series(gdf.geometry.to_wkb(), index=gdf.index)
+
+
+def zoom_tolerance(bounds, frame_size=400):
+    """Simplification tolerance (degrees) of one screen pixel when bounds fit frame_size pixels"""
+
+    minx, miny, maxx, maxy = bounds
+    return max(maxx - minx, maxy - miny, 1e-6) / frame_size
+
+
+def unique_footprints(gdf, tolerance=None):
+    """
+    One row per distinct tile footprint with the number of items, first/last date
+    and lowest cloud cover, simplified to tolerance (one screen pixel by default)
+    """
+
+    aggs = {"count": ("id", "size"), "first": ("date", "min"), "last": ("date", "max")}
+    if "eo:cloud_cover" in gdf:
+        aggs["min_cloud_cover"] = ("eo:cloud_cover", "min")
+
+    key = tile_key(gdf)
+    stats = gdf.groupby(key).agg(**aggs)
+    footprints = gpd.GeoDataFrame(
+        stats,
+        geometry=gdf.geometry.groupby(key).agg(lambda g: g.unary_union),
+        crs=gdf.crs,
+    ).reset_index(drop=True)
+
+    if tolerance is None:
+        tolerance = zoom_tolerance(footprints.total_bounds)
+    footprints["geometry"] = footprints.simplify(tolerance, preserve_topology=True)
+    return footprints
+
+
+def aggregate_footprints(gdf, max_cells=400):
+    """Item counts on a regular grid of at most max_cells cells (by footprint centroid)"""
+
+    minx, miny, maxx, maxy = gdf.total_bounds
+    n = max(1, int(np.sqrt(max_cells)))
+    dx = max(maxx - minx, 1e-6) / n
+    dy = max(maxy - miny, 1e-6) / n
+
+    centroids = gdf.geometry.representative_point()
+    col = np.clip(((centroids.x - minx) // dx).astype(int), 0, n - 1)
+    row = np.clip(((centroids.y - miny) // dy).astype(int), 0, n - 1)
+    cells = gdf.groupby([col.rename("col"), row.rename("row")]).agg(
+        count=("id", "size"), first=("date", "min"), last=("date", "max")
+    ).reset_index()
+
+    geometry = [
+        box(minx + c * dx, miny + r * dy, minx + (c + 1) * dx, miny + (r + 1) * dy)
+        for c, r in zip(cells["col"], cells["row"])
+    ]
+    return gpd.GeoDataFrame(cells.drop(columns=["col", "row"]), geometry=geometry, crs=gdf.crs)
+
+
+def footprint_layer(gdf, max_features=500):
+    """
+    Footprints to draw for a search: de-duplicated and simplified tiles, or an
+    aggregated count grid when there are more than max_features distinct tiles,
+    so the map payload stays roughly constant in the number of items
+    """
+
+    footprints = unique_footprints(gdf)
+    if len(footprints) > max_features:
+        footprints = aggregate_footprints(gdf, max_cells=max_features)
+
+    # Dates as strings for the GeoJSON tooltips
+    for field in ["first", "last"]:
+        footprints[field] = footprints[field].dt.strftime("%Y-%m-%d")
+    return footprints
@@ -1,5 +1,32 @@
 import numpy as np
-from skimage import exposure
+from modules.image_statistics import get_sketch
+from modules.trace_utils import span
+
+
+def dn_to_reflectance(in_data, collection):
+    """
+    Lazily convert the DN of a (dask-backed) datacube to Reflectance (0, 1) as float32.
+    DN 0 (nodata, what stac_load fills uncovered areas with) becomes NaN, so that
+    composites and statistics skip it. Nothing is computed until the pixels are rendered.
+    """
+
+    if collection == "sentinel-2-l2a":
+        return s2_dn_to_reflectance(in_data)
+    elif collection == "landsat-c2-l2":
+        return landsat_dn_to_reflectance(in_data)
+    else:
+        return in_data
+
+
+def drop_scaling_attrs(out_data):
+    """
+    Remove scale_factor/add_offset (e.g. carried over from the DN) from converted data,
+    otherwise CF encoding (to_raster, to_zarr) and decoding would apply them again
+    """
+
+    for attr in ["scale_factor", "add_offset"]:
+        out_data.attrs.pop(attr, None)
+    return out_data
 
 
 def s2_dn_to_reflectance(in_data):
@@ -8,11 +35,11 @@ def s2_dn_to_reflectance(in_data):
     https://docs.sentinel-hub.com/api/latest/data/sentinel-2-l1c/
     """
 
-    quant_value = 1e4
-    in_data.values = in_data / quant_value
-    in_data.values = in_data.clip(0.0, 1.0)
+    quant_value = np.float32(1e4)
+    out_data = (in_data.astype("float32").where(in_data != 0) / quant_value).clip(0.0, 1.0)
+    drop_scaling_attrs(out_data)
 
-    return in_data
+    return out_data
 
 
 def s2_image_to_uint8(in_data):
@@ -35,41 +62,87 @@ def s2_contrast_stretch(in_data, clip_range=(2.5, 97.5)):
     Image enhancement: Contrast stretching.
     """
 
-    pmin, pmax = np.percentile(in_data, clip_range)
-    in_data.values = exposure.rescale_intensity(in_data, in_range=(pmin, pmax))
-    print(f"scaling to range {pmin} : {pmax}")
+    # Percentiles come from a cached histogram of the reflectance (0, 1)
+    with span("contrast_stretch") as s:
+        pmin, pmax = get_sketch(in_data, value_range=(0.0, 1.0)).percentiles(clip_range)
+        s.attrs.update(pmin=float(pmin), pmax=float(pmax))
 
-    return in_data
+    out_data = ((in_data - pmin) / max(pmax - pmin, 1e-6)).clip(0.0, 1.0)
+
+    return out_data.astype("float32")
 
 
 # Scene classification classes: https://usermanual.readthedocs.io/en/stable/pages/ProductGuide.html
-def mask_clouds(to_mask_data, scl_data, is_rgb=True):
+S2_CLOUD_CLASSES = [3, 8, 9, 10]  # cloud shadow, cloud medium/high probability, thin cirrus
+
+# Landsat QA_PIXEL bits: https://www.usgs.gov/landsat-missions/landsat-collection-2-quality-assessment-bands
+LANDSAT_CLOUD_BITS = [1, 2, 3, 4]  # dilated cloud, cirrus, cloud, cloud shadow
+
+
+def cloud_mask(in_data, collection):
     """
-    Clouds masking for RGB/single band images
+    Lazy boolean mask (True = cloudy) from the scl (Sentinel-2) or
+    qa_pixel (Landsat) band of a DN datacube
     """
 
-    to_mask_values = to_mask_data.values
-    scl_values = scl_data.values
+    if collection == "sentinel-2-l2a":
+        return in_data.sel(band="scl").isin(S2_CLOUD_CLASSES)
+
+    # Make a bitmask---when we bitwise-and it with the data, it leaves just the bits we care about
+    bitmask = 0
+    for field in LANDSAT_CLOUD_BITS:
+        bitmask |= 1 << field
+    qa_data = in_data.sel(band="qa_pixel").astype("uint16")
+    return (qa_data & bitmask) != 0
 
-    if is_rgb:
-        to_mask_data.values = np.where((scl_values == 8) | (scl_values == 9), False, to_mask_values)
-    else:
-        to_mask_data.values = np.where((scl_values == 8) | (scl_values == 9), np.nan, to_mask_values)[0, :, :]
-    return to_mask_data
 
-# Mask the clouds (Landsat)
-# if mask_cl:
-    # cl_data = rgb_data.sel(band=["scl"])
+def nodata_mask(in_data, collection):
+    """
+    Lazy boolean mask (True = no data) from the scl (class 0) or
+    qa_pixel (fill bit 0) band of a DN datacube
+    """
+
+    if collection == "sentinel-2-l2a":
+        return in_data.sel(band="scl") == 0
+    qa_data = in_data.sel(band="qa_pixel").astype("uint16")
+    return (qa_data & 1) != 0
+
+
+def mask_clouds(in_data, collection):
+    """
+    Clouds masking: cloudy and no data pixels become NaN and the scl/qa_pixel band is dropped.
+    Stays lazy, each chunk is masked with the matching chunk of the mask band.
+    The DN are cast to float32 first, NaN would otherwise promote them to float64.
+    """
+
+    mask_band = "scl" if collection == "sentinel-2-l2a" else "qa_pixel"
+    invalid = (cloud_mask(in_data, collection) | nodata_mask(in_data, collection)).drop_vars("band")
+
+    return in_data.drop_sel(band=mask_band).astype("float32").where(~invalid)
+
 
-    # qa_data = rgb_data.sel(band=["qa_pixel"])
-    # # Make a bitmask---when we bitwise-and it with the data, it leaves just the 4 bits we care about
-    # mask_bitfields = [1, 2, 3, 4]  # dilated cloud, cirrus, cloud, cloud shadow
-    # bitmask = 0
-    # for field in mask_bitfields:
-    #     bitmask |= 1 << field
-    # cl_data = qa_data & bitmask
+# Methods of temporal_composite
+COMPOSITE_METHODS = ["median", "best"]
+
+
+def temporal_composite(in_data, method="median", cloud_scores=None, chunk_size=512):
+    """
+    Cloud-free composite over the time dimension of a (masked) datacube:
+    the per-pixel median, or the first valid pixel of the least cloudy dates ("best").
+    Only time is rechunked, so memory is bounded by chunk_size x chunk_size x dates.
+    """
+
+    in_data = in_data.chunk({"time": -1, "x": chunk_size, "y": chunk_size})
+
+    if method == "median":
+        return in_data.median("time", skipna=True)
+
+    if method == "best":
+        order = np.argsort(np.asarray(cloud_scores, dtype="float64"), kind="stable")
+        return in_data.isel(time=order).bfill("time").isel(time=0)
+
+    raise ValueError(f"Unknown composite method: {method}")
 
-    # to_mask_data = mask_clouds(rgb_data, cl_data)
 
 def landsat_dn_to_reflectance(in_data):
     """
@@ -77,7 +150,8 @@ def landsat_dn_to_reflectance(in_data):
     https://www.usgs.gov/faqs/how-do-i-use-a-scale-factor-landsat-level-2-science-products
     """
 
-    in_data.values = (in_data * 0.0000275) - 0.2
-    in_data.values = in_data.clip(0.0, 1.0)
+    scale, offset = np.float32(0.0000275), np.float32(-0.2)
+    out_data = (in_data.astype("float32").where(in_data != 0) * scale + offset).clip(0.0, 1.0)
+    drop_scaling_attrs(out_data)
 
-    return in_data
+    return out_data
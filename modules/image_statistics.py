@@ -1,12 +1,148 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import dask
+import dask.array as da
 import panel as pn
+import holoviews as hv
 from bokeh.models import WheelZoomTool
 import hvplot.xarray  # noqa
 from modules.constants import FLOATPANEL_CONFIGS
+from modules.trace_utils import count, span
 
 
-def plot_spindex_kde(index_name, index_data):
+class HistogramSketch:
     """
-    This function shows the density plot of the selected index
+    Fixed-bin histogram of an array, built in one chunked pass.
+    Answers any percentile in O(bins) without touching the pixels again.
+    """
+
+    def __init__(self, counts, edges):
+        self.counts = np.asarray(counts, dtype="int64")
+        self.edges = np.asarray(edges, dtype="float64")
+        self.cumulative = np.cumsum(self.counts)
+
+    @classmethod
+    def from_array(cls, data, bins=2048, value_range=None):
+        """
+        Build the sketch from a (dask-backed) DataArray or array, ignoring NaNs and
+        infinities (e.g. ratio indices over a zero denominator).
+        Without a known value_range, the range costs one extra min/max pass.
+        """
+
+        arr = getattr(data, "data", data)
+        if not isinstance(arr, da.Array):
+            arr = da.from_array(np.asarray(arr))
+        arr = arr.ravel()
+
+        if value_range is None:
+            finite = da.where(da.isfinite(arr), arr, np.nan)
+            vmin, vmax = dask.compute(da.nanmin(finite), da.nanmax(finite))
+            if not np.isfinite(vmin) or not np.isfinite(vmax):
+                vmin, vmax = 0.0, 1.0
+            value_range = (float(vmin), float(vmax) if vmax > vmin else float(vmin) + 1.0)
+
+        counts, edges = da.histogram(arr, bins=bins, range=value_range)
+        return cls(counts.compute(), edges)
+
+    @property
+    def total(self):
+        return int(self.cumulative[-1]) if len(self.cumulative) else 0
+
+    def quantile(self, q):
+        """Value at quantile q (0-1), linearly interpolated inside the bin"""
+
+        if self.total == 0:
+            return np.nan
+        target = q * self.total
+        idx = int(np.searchsorted(self.cumulative, target, side="left"))
+        idx = min(idx, len(self.counts) - 1)
+        below = self.cumulative[idx - 1] if idx > 0 else 0
+        frac = (target - below) / self.counts[idx] if self.counts[idx] else 0.0
+        return float(self.edges[idx] + frac * (self.edges[idx + 1] - self.edges[idx]))
+
+    def percentiles(self, pcts):
+        """Values at percentiles (0-100), e.g. a clip range"""
+
+        return tuple(self.quantile(p / 100) for p in pcts)
+
+    def density(self, value_range=None, bandwidth=None):
+        """
+        Gaussian kernel density estimate from the binned counts (FFT convolution),
+        optionally restricted to value_range (e.g. the clip thresholds).
+        The bandwidth defaults to Silverman's rule computed from the bins.
+        Returns (bin centers, density), in O(bins log bins) whatever the pixel count.
+        """
+
+        centers = (self.edges[:-1] + self.edges[1:]) / 2
+        width = self.edges[1] - self.edges[0]
+        counts = self.counts.astype("float64")
+        if value_range is not None:
+            keep = (centers >= min(value_range)) & (centers <= max(value_range))
+            counts = np.where(keep, counts, 0.0)
+        else:
+            keep = np.ones(len(counts), dtype=bool)
+
+        total = counts.sum()
+        if total == 0:
+            return centers[keep], np.zeros(keep.sum())
+
+        if bandwidth is None:
+            mean = (counts * centers).sum() / total
+            std = np.sqrt((counts * (centers - mean) ** 2).sum() / total)
+            cumulative = np.cumsum(counts)
+            q25, q75 = (centers[np.searchsorted(cumulative, q * total)] for q in (0.25, 0.75))
+            spread = min(std, (q75 - q25) / 1.34) or std or width
+            bandwidth = 0.9 * spread * total ** (-1 / 5)
+
+        # Gaussian kernel sampled on the bin grid, +/- 4 sigma
+        sigma = max(bandwidth / width, 1e-3)
+        half = min(int(np.ceil(4 * sigma)), len(counts))
+        offsets = np.arange(-half, half + 1)
+        kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+        kernel /= kernel.sum()
+
+        size = len(counts) + len(kernel) - 1
+        smoothed = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)
+        smoothed = np.clip(smoothed[half:half + len(counts)], 0.0, None)
+
+        density = smoothed / (total * width)
+        return centers[keep], density[keep]
+
+
+_SKETCHES = OrderedDict()
+_SKETCHES_LOCK = threading.Lock()
+MAX_SKETCHES = 256
+
+
+def get_sketch(data, bins=2048, value_range=None):
+    """
+    Cached HistogramSketch of data. The key is the dask token of the array,
+    so each (date, band or index) selection is scanned only once.
+    """
+
+    key = (dask.base.tokenize(getattr(data, "data", data)), bins, value_range)
+    with _SKETCHES_LOCK:
+        sketch = _SKETCHES.get(key)
+        if sketch is not None:
+            _SKETCHES.move_to_end(key)
+            count("cache.sketch.hit")
+            return sketch
+    count("cache.sketch.miss")
+
+    with span("sketch", bins=bins):
+        sketch = HistogramSketch.from_array(data, bins=bins, value_range=value_range)
+    with _SKETCHES_LOCK:
+        _SKETCHES[key] = sketch
+        while len(_SKETCHES) > MAX_SKETCHES:
+            _SKETCHES.popitem(last=False)
+    return sketch
+
+
+def plot_spindex_kde(index_name, sketch, value_range=None):
+    """
+    This function shows the density plot of the selected index,
+    estimated from its (cached) histogram sketch within value_range
     """
 
     def hook(plot, element):
@@ -20,11 +156,10 @@ def plot_spindex_kde(index_name, index_data):
                 tool.zoom_on_axis = False
                 break
 
-    # Convert to dataset
-    plot_data = index_data.to_dataset(name="Index")
-    kde_plot = plot_data.hvplot.kde(
-        "Index", title="", xlabel=f"{index_name}", alpha=0.5, hover=False
-    )
+    centers, density = sketch.density(value_range)
+    kde_plot = hv.Area(
+        (centers, density), kdims=[hv.Dimension("Index", label=f"{index_name}")], vdims=["Density"]
+    ).opts(title="", alpha=0.5, tools=[])
 
     kde_plot.opts(hooks=[hook])
 
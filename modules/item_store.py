@@ -0,0 +1,149 @@
+import json
+import threading
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pystac
+from shapely.geometry import box, shape
+
+# Parsed to typed columns once, on append
+NUMERIC_FIELDS = ["eo:cloud_cover", "view:sun_azimuth", "view:sun_elevation"]
+
+
+def _to_row(feature):
+    """Flatten the scalar properties of a STAC feature into a table row"""
+
+    row = {
+        k: v
+        for k, v in feature["properties"].items()
+        if not isinstance(v, (list, dict))
+    }
+    row["id"] = feature["id"]
+    row["collection"] = feature.get("collection")
+    row["geometry"] = shape(feature["geometry"])
+    return row
+
+
+class ItemStore:
+    """
+    Columnar store for the items of a STAC search, shared by all MapManager tools.
+    Properties are parsed once into a typed GeoDataFrame (datetime64, float cloud cover)
+    with an STRtree spatial index. The features themselves are kept as an Arrow
+    string column (JSON) and pystac Items are only built for the rows that are read,
+    once per row.
+    Features can be appended while a streaming search is still running.
+    `key` identifies the item set (e.g. the digest of the normalized search).
+    """
+
+    def __init__(self, features=None, key=None):
+        self.key = key
+        self._features = []  # Arrow chunks (one per append) of the features as JSON
+        self._count = 0
+        self._parsed = {}  # row -> pystac Item, for the rows read so far
+        self._pending = []
+        self._frames = []
+        self._gdf = None
+        self._lock = threading.Lock()
+        if features:
+            self.append(features)
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def append(self, features):
+        """Add a batch (e.g. one search page) of STAC features"""
+
+        chunk = pa.array([json.dumps(f) for f in features], type=pa.large_string())
+        rows = [_to_row(f) for f in features]
+        with self._lock:
+            self._features.append(chunk)
+            self._count += len(chunk)
+            self._pending.extend(rows)
+            self._gdf = None
+
+    @property
+    def gdf(self):
+        """Typed GeoDataFrame of the items (row order == item order)"""
+
+        with self._lock:
+            if self._gdf is None:
+                if self._pending:
+                    frame = pd.DataFrame(self._pending)
+                    frame["datetime"] = pd.to_datetime(frame["datetime"], utc=True)
+                    for field in NUMERIC_FIELDS:
+                        if field in frame:
+                            frame[field] = pd.to_numeric(frame[field], errors="coerce").astype("float32")
+                    self._frames.append(frame)
+                    self._pending = []
+                frame = pd.concat(self._frames, ignore_index=True) if self._frames else pd.DataFrame(
+                    {"id": [], "datetime": pd.to_datetime([], utc=True), "geometry": []}
+                )
+                frame["date"] = frame["datetime"].dt.tz_convert(None).dt.normalize()
+                self._frames = [frame.drop(columns="date")]
+                self._gdf = gpd.GeoDataFrame(frame, geometry="geometry", crs="EPSG:4326")
+            return self._gdf
+
+    def dates(self):
+        """Unique acquisition dates (datetime.date), newest first"""
+
+        return [d.date() for d in sorted(self.gdf["date"].unique(), reverse=True)]
+
+    def query(self, bbox=None, date=None, order_by=None):
+        """
+        Row positions of items intersecting bbox (minx, miny, maxx, maxy, EPSG:4326)
+        and/or acquired on date (or within an inclusive (start, end) date window),
+        using the STRtree index for the spatial part.
+        Rows are sorted by the order_by column (ascending) if given.
+        """
+
+        gdf = self.gdf
+        if bbox is not None:
+            if isinstance(bbox, str):
+                bbox = tuple(map(float, bbox.split(",")))
+            rows = sorted(gdf.sindex.query(box(*bbox), predicate="intersects"))
+        else:
+            rows = list(range(len(gdf)))
+        if date is not None:
+            start, end = date if isinstance(date, tuple) else (date, date)
+            on_date = gdf["date"].between(pd.Timestamp(start), pd.Timestamp(end)).to_numpy()
+            rows = [r for r in rows if on_date[r]]
+        if order_by is not None:
+            values = gdf[order_by].to_numpy()
+            rows = sorted(rows, key=lambda r: values[r])
+        return rows
+
+    def cloud_scores(self, times):
+        """Mean eo:cloud_cover of the items acquired at each of times (e.g. a cube's time coordinate)"""
+
+        gdf = self.gdf
+        scores = gdf.groupby(gdf["datetime"].dt.tz_convert(None))["eo:cloud_cover"].mean()
+        return scores.reindex(pd.DatetimeIndex(times), method="nearest").to_numpy()
+
+    def items(self, rows=None):
+        """
+        pystac ItemCollection for the given row positions (all items by default).
+        Each row's JSON is parsed the first time it is read, later loads (dates,
+        prefetches, zooms, exports) reuse the Item.
+        """
+
+        with self._lock:
+            rows = list(range(self._count)) if rows is None else list(rows)
+            todo = [r for r in rows if r not in self._parsed]
+            features = pa.chunked_array(self._features, type=pa.large_string())
+        if todo:
+            parsed = features.take(pa.array(todo, type=pa.int64())).to_pylist()
+            items = {r: pystac.Item.from_dict(json.loads(f)) for r, f in zip(todo, parsed)}
+            with self._lock:
+                self._parsed.update(items)
+        with self._lock:
+            items = [self._parsed[r] for r in rows]
+        return pystac.ItemCollection(items, clone_items=False)
+
+    def to_parquet(self, path):
+        """Write the item table as GeoParquet, with the full features in its 'stac' column"""
+
+        gdf = self.gdf
+        with self._lock:
+            features = pa.chunked_array(self._features, type=pa.large_string())
+        gdf.assign(stac=features.to_pylist()[:len(gdf)]).to_parquet(path)
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from langchain.cache import BaseCache
+from langchain.load.load import loads
+from langchain.schema import ChatGeneration, Generation, HumanMessage, SystemMessage
+from langchain.schema import messages_from_dict, messages_to_dict
+from modules.cache_utils import CACHE_DIR
+from modules.trace_utils import count
+
+# Misses waiting for their update (LLM calls that fail never get one), oldest dropped first
+MAX_PENDING_MISSES = 1024
+
+
+def normalize_text(text):
+    """Lowercase, drop punctuation and collapse whitespace"""
+
+    text = re.sub(r"[^\w\s]", " ", str(text).lower())
+    return " ".join(text.split())
+
+
+def _digest(*parts):
+    return hashlib.sha1("\x1f".join(parts).encode()).hexdigest()
+
+
+def _dump_generations(generations):
+    out = []
+    for gen in generations:
+        if isinstance(gen, ChatGeneration):
+            out.append({"text": gen.text, "message": messages_to_dict([gen.message])[0]})
+        else:
+            out.append({"text": gen.text})
+    return json.dumps(out)
+
+
+def _load_generations(value):
+    generations = []
+    for gen in json.loads(value):
+        if "message" in gen:
+            generations.append(ChatGeneration(message=messages_from_dict([gen["message"]])[0]))
+        else:
+            generations.append(Generation(text=gen["text"]))
+    return generations
+
+
+def _is_function_call(generations):
+    return any(
+        isinstance(gen, ChatGeneration) and "function_call" in gen.message.additional_kwargs
+        for gen in generations
+    )
+
+
+class SatGPTLLMCache(BaseCache):
+    """
+    Persistent (SQLite) LLM response cache with TTL, set as `langchain.llm_cache`.
+
+    Exact hits need the same model parameters and full prompt (history included).
+    Normalized hits only look at the system prompt and the conversation from the
+    last user message on, with case/punctuation/spacing normalized; they only
+    replay function calls (tool plans), the tools themselves still run.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, "llm_cache.sqlite"), ttl=7 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.normalized_hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.llm_seconds = 0.0  # time between a miss and its update, i.e. the LLM call
+        self.llm_calls = 0
+        self._missed_at = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache "
+            "(key TEXT PRIMARY KEY, value TEXT, function_call INTEGER, created REAL)"
+        )
+        self._conn.commit()
+
+    def _keys(self, prompt, llm_string):
+        exact = _digest("exact", llm_string, prompt)
+        try:
+            messages = loads(prompt)
+        except Exception:
+            return exact, None
+        if not isinstance(messages, list):
+            return exact, None
+
+        last_human = max(
+            (i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=None
+        )
+        if last_human is None:
+            return exact, None
+
+        system = [m.content for m in messages if isinstance(m, SystemMessage)]
+        tail = [
+            f"{m.type}:{normalize_text(m.content)}:{json.dumps(m.additional_kwargs, sort_keys=True)}"
+            for m in messages[last_human:]
+        ]
+        return exact, _digest("normalized", llm_string, *system, *tail)
+
+    def _get(self, key, function_call_only=False):
+        query = "SELECT value, created FROM llm_cache WHERE key = ?"
+        if function_call_only:
+            query += " AND function_call = 1"
+        with self._lock:
+            row = self._conn.execute(query, (key,)).fetchone()
+        if row is None:
+            return None
+        if self.ttl is not None and time.time() - row[1] > self.ttl:
+            with self._lock:
+                self._conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._conn.commit()
+            return None
+        return _load_generations(row[0])
+
+    def lookup(self, prompt, llm_string):
+        start = time.perf_counter()
+        exact, normalized = self._keys(prompt, llm_string)
+
+        value = self._get(exact)
+        if value is not None:
+            self.hits += 1
+            count("cache.llm.hit")
+        elif normalized is not None:
+            value = self._get(normalized, function_call_only=True)
+            if value is not None:
+                self.hits += 1
+                self.normalized_hits += 1
+                count("cache.llm.normalized_hit")
+
+        if value is None:
+            self.misses += 1
+            count("cache.llm.miss")
+            with self._lock:
+                self._missed_at[exact] = time.perf_counter()
+                while len(self._missed_at) > MAX_PENDING_MISSES:
+                    self._missed_at.popitem(last=False)
+        self.lookup_seconds += time.perf_counter() - start
+        return value
+
+    def update(self, prompt, llm_string, return_val):
+        exact, normalized = self._keys(prompt, llm_string)
+
+        with self._lock:
+            missed_at = self._missed_at.pop(exact, None)
+        if missed_at is not None:
+            self.llm_seconds += time.perf_counter() - missed_at
+            self.llm_calls += 1
+
+        value = _dump_generations(return_val)
+        function_call = int(_is_function_call(return_val))
+        rows = [(exact, value, function_call, time.time())]
+        if normalized is not None:
+            rows.append((normalized, value, function_call, time.time()))
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._conn.execute("DELETE FROM llm_cache")
+            self._conn.commit()
+
+    @property
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "normalized_hits": self.normalized_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "mean_lookup_ms": 1000 * self.lookup_seconds / lookups if lookups else 0.0,
+            "mean_llm_ms": 1000 * self.llm_seconds / self.llm_calls if self.llm_calls else 0.0,
+        }
+
+
+# Shared by all sessions
+LLM_CACHE = SatGPTLLMCache()
@@ -0,0 +1,230 @@
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import dask.array as da
+import xarray as xr
+from odc.stac import stac_load
+from modules.spyndex_utils import BAND_MAPPING, get_index_props
+from modules.datacube_utils import RGB_BANDS
+from modules.trace_utils import count, span, submit
+
+# Shared by all sessions, background loads of adjacent dates run here
+PREFETCH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="cube-prefetch")
+
+EARTH_RADIUS = 6378137.0
+NATIVE_RESOLUTION = {"sentinel-2-l2a": 10, "landsat-c2-l2": 30}
+
+
+def bbox_to_3857(bbox):
+    """Convert a (minx, miny, maxx, maxy) lon/lat bbox to web mercator x/y ranges"""
+
+    if isinstance(bbox, str):
+        bbox = tuple(map(float, bbox.split(",")))
+    minx, miny, maxx, maxy = bbox
+
+    def merc_y(lat):
+        return EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+    x_range = (EARTH_RADIUS * math.radians(minx), EARTH_RADIUS * math.radians(maxx))
+    y_range = (merc_y(miny), merc_y(maxy))
+    return x_range, y_range
+
+
+def bbox_from_3857(x_range, y_range):
+    """Convert web mercator x/y ranges (e.g. from a RangeXY stream) to a lon/lat bbox"""
+
+    def lat(y):
+        return math.degrees(2 * math.atan(math.exp(y / EARTH_RADIUS)) - math.pi / 2)
+
+    return (
+        math.degrees(x_range[0] / EARTH_RADIUS),
+        lat(y_range[0]),
+        math.degrees(x_range[1] / EARTH_RADIUS),
+        lat(y_range[1]),
+    )
+
+
+def native_resolution(bbox, collection, meters=None):
+    """
+    EPSG:3857 resolution of `meters` on the ground (the collection's native
+    resolution by default) at the latitude of bbox
+    """
+
+    if isinstance(bbox, str):
+        bbox = tuple(map(float, bbox.split(",")))
+    # Mercator stretches ground distances by 1/cos(lat)
+    lat = math.radians((bbox[1] + bbox[3]) / 2)
+    return (meters or NATIVE_RESOLUTION.get(collection, 10)) / math.cos(lat)
+
+
+def pick_resolution(bbox, collection, frame_size=500):
+    """
+    Coarsest resolution (EPSG:3857 units) that still fills a frame_size frame for bbox.
+    Resolutions are power-of-two multiples of the native one so that reads line up
+    with COG overview levels, which GDAL picks automatically when downsampling.
+    """
+
+    if isinstance(bbox, str):
+        bbox = tuple(map(float, bbox.split(",")))
+    x_range, y_range = bbox_to_3857(bbox)
+    extent = max(x_range[1] - x_range[0], y_range[1] - y_range[0])
+    native = native_resolution(bbox, collection)
+
+    level = max(0, math.floor(math.log2(max(extent / frame_size, native) / native)))
+    return native * 2**level
+
+
+def plan_bands(collection, comp_index, mask_clouds=False):
+    """
+    List the STAC bands (assets) needed to render a composite or index,
+    plus the scl/qa_pixel band if clouds are masked
+    """
+
+    if comp_index == "RGB":
+        bands = list(RGB_BANDS)
+    else:
+        bands = list(get_index_props(comp_index.strip('\"'), collection)["stac_bands"])
+
+    if mask_clouds:
+        bands.append(BAND_MAPPING[collection]["999"])
+
+    return bands
+
+
+def load_cube(store, collection, time, bands=None, bbox=None, resolution=None, geobox=None):
+    """
+    Lazily load the DN (uint16) datacube of the store's items acquired on time
+    (a date or an inclusive (start, end) window) that intersect bbox, on an
+    EPSG:3857 grid of the given resolution or on geobox (e.g. a map tile).
+    Tiles of the same pass are mosaicked into one time slice per solar day.
+    Returns None if no item matches.
+    """
+
+    # Only tiles intersecting the bbox are read. Overlap rule: odc-stac fuses each
+    # group in item order (first valid pixel wins), so the least cloudy tile goes first.
+    with span("stac_load.query") as s:
+        rows = store.query(bbox=bbox, date=time, order_by="eo:cloud_cover")
+        s.attrs["items"] = len(rows)
+    if not rows:
+        return None
+
+    if bands is None:
+        bands = list(BAND_MAPPING[collection].values())
+    if geobox is not None:
+        grid = {"geobox": geobox}
+    else:
+        grid = {"bbox": bbox, "resolution": resolution, "crs": "EPSG:3857"}
+
+    with span("stac_load.plan", date=str(time), bands=",".join(bands), resolution=resolution or ""):
+        return stac_load(
+            store.items(rows),
+            bands=bands,
+            chunks={'time': 1, 'x': 2048, 'y': 2048},
+            groupby="solar_day",
+            # Fuse in query order (least cloudy first) instead of odc-stac's (time, id) sort
+            preserve_original_order=True,
+            **grid,
+            ).to_array(dim="band")
+
+
+def empty_cube(collection, bbox, resolution, time, bands=None):
+    """
+    All-NaN (band, time, y, x) cube on the EPSG:3857 grid of bbox, standing in
+    for load_cube where no item covers the bbox on that date
+    """
+
+    if bands is None:
+        bands = list(BAND_MAPPING[collection].values())
+
+    if isinstance(bbox, str):
+        bbox = tuple(map(float, bbox.split(",")))
+    x_range, y_range = bbox_to_3857(bbox)
+    xs = np.arange(x_range[0] + resolution / 2, x_range[1], resolution)
+    ys = np.arange(y_range[1] - resolution / 2, y_range[0], -resolution)
+    day = time[-1] if isinstance(time, tuple) else time
+
+    data = da.full(
+        (len(bands), 1, len(ys), len(xs)), np.nan, dtype="float32", chunks=(1, 1, 2048, 2048)
+    )
+    return xr.DataArray(
+        data,
+        dims=("band", "time", "y", "x"),
+        coords={"band": list(bands), "time": [np.datetime64(day, "ns")], "y": ys, "x": xs},
+    )
+
+
+class DateCubeLoader:
+    """
+    Loads a datacube one acquisition date at a time, and only the bands asked for.
+    The date being viewed is loaded first, its neighbours are prefetched in the
+    background and at most `max_resident` dates are kept in memory (LRU).
+    Bands missing from a resident date are loaded and added to it incrementally.
+    """
+
+    def __init__(self, load_fn, dates, max_resident=5, prefetch=1):
+        self.load_fn = load_fn
+        self.dates = sorted(dates)
+        self.max_resident = max_resident
+        self.prefetch = prefetch
+        self._cubes = OrderedDict()  # date -> (bands, future)
+        self._lock = threading.Lock()
+
+    def _load(self, date, bands, base=None):
+        # Pull the pixels now so that viewing the date later is instant
+        with span("stac_load", date=str(date), bands=",".join(bands)) as s:
+            data = self.load_fn(date, bands=bands)
+            if data is None:
+                # Raised by the future, i.e. only when the date is actually viewed
+                raise LookupError(f"No items for {date}")
+            data = data.persist()
+            s.attrs["bytes"] = int(data.nbytes)
+        count("bytes_read", int(data.nbytes))
+        if base is not None:
+            data = xr.concat([base.result(), data], dim="band")
+        return data
+
+    def _submit(self, date, bands, keep=None):
+        with self._lock:
+            have, future = self._cubes.get(date, (frozenset(), None))
+            if future is not None and future.done() and (future.cancelled() or future.exception() is not None):
+                # A failed load (e.g. a transient S3/network error) is retried, not kept
+                have, future = frozenset(), None
+            missing = [b for b in bands if b not in have]
+            if missing:
+                future = submit(PREFETCH_POOL, self._load, date, missing, base=future)
+                self._cubes[date] = (have | frozenset(missing), future)
+            self._cubes.move_to_end(date)
+            if keep in self._cubes:
+                self._cubes.move_to_end(keep)
+            while len(self._cubes) > self.max_resident:
+                _, (_, evicted) = self._cubes.popitem(last=False)
+                evicted.cancel()
+        return future
+
+    def get(self, date, bands):
+        """Return the (persisted) cube for date with at least `bands`, prefetching its neighbours"""
+
+        future = self._submit(date, bands)
+
+        if date in self.dates:
+            pos = self.dates.index(date)
+            neighbours = []
+            for step in range(1, self.prefetch + 1):
+                neighbours += [pos - step, pos + step]
+            for npos in neighbours:
+                if 0 <= npos < len(self.dates):
+                    # Prefetching must never evict the requested date
+                    self._submit(self.dates[npos], bands, keep=date)
+
+        return future.result()
+
+    @property
+    def resident(self):
+        with self._lock:
+            return {
+                d: sorted(bands)
+                for d, (bands, f) in self._cubes.items()
+                if f.done() and not f.cancelled()
+            }
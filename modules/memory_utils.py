@@ -0,0 +1,66 @@
+import asyncio
+import re
+from typing import Any
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema import SystemMessage
+
+
+def tool_state(map_mgr):
+    """One line summary of the manager's current search, e.g. 'bbox=...; items=42'"""
+
+    if map_mgr is None:
+        return ""
+
+    state = {
+        "bbox": map_mgr.bbox or None,
+        "collection": getattr(map_mgr, "collection", None),
+        "dtime": getattr(map_mgr, "dtime", None),
+        "items": len(map_mgr.store) if map_mgr.store is not None else None,
+    }
+    return "; ".join(f"{k}={v}" for k, v in state.items() if v is not None)
+
+
+class BudgetedMemory(ConversationSummaryBufferMemory):
+    """
+    Conversation memory with a hard token budget: the most recent turns are kept
+    verbatim up to max_token_limit, older turns are folded into a running summary
+    capped at summary_token_limit, and the current search (bbox, collection, dtime,
+    item count) is passed as a single compact system message instead of prose.
+    Saving a turn never blocks: summarizing (an LLM call) happens in aprune,
+    which the session awaits on a worker thread after the turn.
+    """
+
+    map_mgr: Any = None
+    summary_token_limit: int = 300
+
+    def load_memory_variables(self, inputs):
+        variables = super().load_memory_variables(inputs)
+        state = tool_state(self.map_mgr)
+        if state and self.return_messages:
+            variables[self.memory_key] = [
+                SystemMessage(content=f"Current search: {state}")
+            ] + variables[self.memory_key]
+        return variables
+
+    def save_context(self, inputs, outputs):
+        # Only record the turn, the chain calls this synchronously on the event loop
+        BaseChatMemory.save_context(self, inputs, outputs)
+
+    async def asave_context(self, inputs, outputs):
+        BaseChatMemory.save_context(self, inputs, outputs)
+        await self.aprune()
+
+    async def aprune(self):
+        """Fold the turns over the budget into the summary without blocking the event loop"""
+
+        await asyncio.to_thread(self.prune)
+
+    def prune(self):
+        super().prune()
+
+        # Keep the summary itself bounded by dropping its oldest sentences
+        sentences = re.split(r"(?<=[.!?])\s+", self.moving_summary_buffer.strip())
+        while len(sentences) > 1 and self.llm.get_num_tokens(" ".join(sentences)) > self.summary_token_limit:
+            sentences.pop(0)
+        self.moving_summary_buffer = " ".join(sentences)
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+import pandas as pd
+
+# Time bins of summarize_metadata, as pandas frequencies. Bins are closed and labelled
+# on the left, i.e. weeks run Monday-Sunday and are labelled by their Monday
+PERIODS = {"daily": "D", "weekly": "W-MON", "monthly": "MS"}
+
+_SUMMARIES = OrderedDict()
+_SUMMARIES_LOCK = threading.Lock()
+MAX_SUMMARIES = 64
+
+
+def filter_items(gdf, max_cloud_cover=None, platform=None, start=None, end=None):
+    """Boolean mask of the items matching all the given filters (vectorized)"""
+
+    mask = pd.Series(True, index=gdf.index)
+    if max_cloud_cover is not None:
+        mask &= gdf["eo:cloud_cover"] <= max_cloud_cover
+    if platform is not None and "platform" in gdf:
+        mask &= gdf["platform"].str.lower() == platform.lower()
+    if start is not None:
+        mask &= gdf["date"] >= pd.Timestamp(start)
+    if end is not None:
+        mask &= gdf["date"] <= pd.Timestamp(end)
+    return mask
+
+
+def summarize_metadata(gdf, period="monthly", field="eo:cloud_cover", **filters):
+    """
+    Per time bin (daily/weekly/monthly) item count, mean/min/max of field
+    and item count per platform, over the items matching filters
+    """
+
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {list(PERIODS)}, not {period!r}")
+
+    gdf = gdf.loc[filter_items(gdf, **filters)]
+    # W-MON defaults to closed/labelled on the right (Tuesday-Monday weeks)
+    bins = pd.Grouper(key="date", freq=PERIODS[period], closed="left", label="left")
+
+    table = gdf.groupby(bins).agg(
+        count=("id", "size"),
+        mean=(field, "mean"),
+        min=(field, "min"),
+        max=(field, "max"),
+    )
+    table.columns = ["count"] + [f"{stat} {field}" for stat in ["mean", "min", "max"]]
+
+    if "platform" in gdf:
+        platforms = gdf.groupby([bins, "platform"]).size().unstack(fill_value=0)
+        table = table.join(platforms)
+        table[platforms.columns] = table[platforms.columns].fillna(0).astype(int)
+
+    table.index = table.index.strftime("%Y-%m-%d")
+    table.index.name = period
+    return table
+
+
+def get_summary(store, period="monthly", field="eo:cloud_cover", **filters):
+    """
+    Cached summarize_metadata of an ItemStore. The key includes the store's
+    search key and size, so a summary is recomputed only when items arrive.
+    """
+
+    key = (store.key or id(store), len(store), period, field, tuple(sorted(filters.items())))
+    with _SUMMARIES_LOCK:
+        table = _SUMMARIES.get(key)
+        if table is not None:
+            _SUMMARIES.move_to_end(key)
+            return table
+
+    table = summarize_metadata(store.gdf, period, field, **filters)
+    with _SUMMARIES_LOCK:
+        _SUMMARIES[key] = table
+        while len(_SUMMARIES) > MAX_SUMMARIES:
+            _SUMMARIES.popitem(last=False)
+    return table
@@ -0,0 +1,328 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import aiohttp
+from pystac_client.client import Client
+from requests.adapters import HTTPAdapter
+from modules.trace_utils import count, span, submit
+
+# Shared by all sessions, sub-queries of every search run here
+SEARCH_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stac-search")
+
+# Seconds the search tools wait for something to show before giving up
+FIRST_PAGE_TIMEOUT = 60
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(url, pool_size=16):
+    """
+    Return the shared pystac_client Client for a catalog url, opening it
+    (and its pooled HTTP session) only once
+    """
+
+    key = url.strip().rstrip("/")
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = Client.open(url)
+            # Size the connection pool for concurrent sub-queries
+            session = getattr(getattr(client, "_stac_io", None), "session", None)
+            if session is not None:
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+            _CLIENTS[key] = client
+    return client
+
+
+def split_bbox(bbox, max_span=1.0):
+    """Split a (minx, miny, maxx, maxy) bbox into tiles no larger than max_span degrees"""
+
+    minx, miny, maxx, maxy = bbox
+    nx = max(1, int(-(-(maxx - minx) // max_span)))
+    ny = max(1, int(-(-(maxy - miny) // max_span)))
+    dx = (maxx - minx) / nx
+    dy = (maxy - miny) / ny
+
+    return [
+        (minx + i * dx, miny + j * dy, minx + (i + 1) * dx, miny + (j + 1) * dy)
+        for i in range(nx)
+        for j in range(ny)
+    ]
+
+
+def split_datetime(dtime, max_days=31):
+    """
+    Split a 'YYYY-MM-DD/YYYY-MM-DD' range into disjoint sub-ranges of at most max_days.
+    Anything else (single dates, open ranges, times) is returned unchanged.
+    """
+
+    parts = str(dtime).split("/")
+    if len(parts) != 2 or not all(len(p.strip()) == 10 for p in parts):
+        return [dtime]
+    try:
+        start, end = (date.fromisoformat(p.strip()) for p in parts)
+    except ValueError:
+        return [dtime]
+
+    ranges = []
+    while start <= end:
+        stop = min(start + timedelta(days=max_days - 1), end)
+        ranges.append(f"{start.isoformat()}/{stop.isoformat()}")
+        start = stop + timedelta(days=1)
+    return ranges
+
+
+class StreamingSearch:
+    """
+    A STAC search split into concurrent bbox/time sub-queries.
+    Features are de-duplicated and streamed to `on_page` as pages arrive.
+    """
+
+    def __init__(self, url, collection, bbox, dtime, page_size=100, on_page=None, on_done=None):
+        if isinstance(bbox, str):
+            bbox = tuple(map(float, bbox.split(",")))
+        self.url = url
+        self.collection = collection
+        self.bbox = tuple(bbox)
+        self.dtime = dtime
+        self.page_size = page_size
+        self.on_page = on_page
+        self.on_done = on_done
+
+        self.count = None
+        self.errors = []
+        self.done = threading.Event()
+        self.first_page = threading.Event()
+
+        self._features = []
+        self._ids = set()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._futures = []
+
+    def start(self):
+        """Fetch the match count (a single small request) and launch the sub-queries"""
+
+        client = get_client(self.url)
+        with span("stac_search.count") as s:
+            self.count = client.search(
+                collections=[self.collection], bbox=self.bbox, datetime=self.dtime, limit=1
+            ).matched()
+            s.attrs["matched"] = self.count
+
+        subqueries = [
+            (bbox, dtime)
+            for bbox in split_bbox(self.bbox)
+            for dtime in split_datetime(self.dtime)
+        ]
+        self._pending = len(subqueries)
+        for bbox, dtime in subqueries:
+            future = submit(SEARCH_POOL, self._run, client, bbox, dtime)
+            future.add_done_callback(self._finished)
+            self._futures.append(future)
+
+        return self
+
+    def _run(self, client, bbox, dtime):
+        search = client.search(
+            collections=[self.collection], bbox=bbox, datetime=dtime, limit=self.page_size
+        )
+        # A page is fetched while the generator advances, time it from the previous page
+        start = time.perf_counter()
+        for page in search.pages_as_dicts():
+            self._page_done(start, page)
+            start = time.perf_counter()
+
+    def _page_done(self, start, page):
+        features = page.get("features", [])
+        with span("stac_search.page", features=len(features)) as s:
+            s.start = start
+            self._add(features)
+        count("stac_search.pages")
+
+    def _add(self, features):
+        with self._lock:
+            new = [f for f in features if f["id"] not in self._ids]
+            self._ids.update(f["id"] for f in new)
+            self._features.extend(new)
+        if not new:
+            # Empty pages (e.g. an ocean tile or an empty month) are not something to show,
+            # _finished still releases the waiters if every sub-query comes back empty
+            return
+        if self.on_page is not None:
+            self.on_page(new)
+        self.first_page.set()
+
+    def _finished(self, future):
+        if future.cancelled():
+            self.errors.append(RuntimeError("STAC search cancelled"))
+        elif future.exception() is not None:
+            self.errors.append(future.exception())
+        with self._lock:
+            self._pending -= 1
+            last = self._pending == 0
+        if last:
+            self.first_page.set()
+            self.done.set()
+            if self.on_done is not None and not self.errors:
+                self.on_done(self.feature_collection())
+
+    def first_page_result(self, timeout=FIRST_PAGE_TIMEOUT):
+        """
+        Block until the first page has arrived (or every sub-query has finished).
+        Raises TimeoutError after timeout seconds, and the first failure if
+        the sub-queries failed before anything was loaded.
+        """
+
+        if not self.first_page.wait(timeout):
+            self.cancel()
+            raise TimeoutError(f"STAC search returned no page within {timeout}s")
+        self._check_first_page()
+        return self.feature_collection()
+
+    def _check_first_page(self):
+        with self._lock:
+            loaded = len(self._features)
+        if self.errors and not loaded:
+            raise self.errors[0]
+
+    def cancel(self):
+        """Stop the sub-queries (the pending ones for threads, all of them for tasks)"""
+
+        for future in self._futures:
+            future.cancel()
+
+    def feature_collection(self):
+        """Snapshot of the features received so far, newest first like the catalog returns them"""
+
+        with self._lock:
+            features = list(self._features)
+        features.sort(key=lambda f: f["properties"].get("datetime") or "", reverse=True)
+        return {"type": "FeatureCollection", "features": features}
+
+    def wait(self, timeout=None):
+        """Block until every sub-query has finished, re-raising the first failure"""
+
+        self.done.wait(timeout)
+        if self.errors:
+            raise self.errors[0]
+        return self.feature_collection()
+
+
+_HTTP_SESSIONS = {}
+
+
+def get_http_session(pool_size=32):
+    """
+    Return the aiohttp session (and its connection pool) shared by all
+    coroutines of the running event loop
+    """
+
+    loop = asyncio.get_running_loop()
+    session = _HTTP_SESSIONS.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=pool_size)
+        session = _HTTP_SESSIONS[loop] = aiohttp.ClientSession(connector=connector)
+    return session
+
+
+def to_rfc3339_interval(dtime):
+    """Expand plain dates ('YYYY-MM-DD' or ranges of them) to the RFC 3339 interval STAC APIs expect"""
+
+    parts = str(dtime).split("/")
+    if len(parts) == 1:
+        parts = [parts[0], parts[0]]
+    start, end = (p.strip() for p in parts)
+    if len(start) == 10:
+        start += "T00:00:00Z"
+    if len(end) == 10:
+        end += "T23:59:59Z"
+    return f"{start}/{end}"
+
+
+async def _fetch_json(http, method, url, body=None):
+    async with http.request(method, url, json=body if method == "POST" else None) as resp:
+        resp.raise_for_status()
+        return await resp.json()
+
+
+class AsyncStreamingSearch(StreamingSearch):
+    """
+    StreamingSearch on asyncio: the sub-queries are tasks of the running loop that
+    POST to the catalog's /search endpoint through the shared aiohttp pool and
+    follow its "next" links, so no thread is held while waiting on the network.
+    """
+
+    def _body(self, bbox, dtime, limit):
+        return {
+            "collections": [self.collection],
+            "bbox": list(bbox),
+            "datetime": to_rfc3339_interval(dtime),
+            "limit": limit,
+        }
+
+    async def start(self):
+        """Fetch the match count (a single small request) and launch the sub-queries"""
+
+        self._first_page_async = asyncio.Event()
+        http = get_http_session()
+        with span("stac_search.count") as s:
+            first = await _fetch_json(
+                http, "POST", f"{self.url.rstrip('/')}/search", self._body(self.bbox, self.dtime, 1)
+            )
+            self.count = first.get("numberMatched", first.get("context", {}).get("matched"))
+            s.attrs["matched"] = self.count
+
+        subqueries = [
+            (bbox, dtime)
+            for bbox in split_bbox(self.bbox)
+            for dtime in split_datetime(self.dtime)
+        ]
+        self._pending = len(subqueries)
+        for bbox, dtime in subqueries:
+            task = asyncio.create_task(self._arun(http, bbox, dtime))
+            task.add_done_callback(self._finished)
+            self._futures.append(task)
+
+        return self
+
+    async def _arun(self, http, bbox, dtime):
+        method, href = "POST", f"{self.url.rstrip('/')}/search"
+        body = self._body(bbox, dtime, self.page_size)
+        while href is not None:
+            start = time.perf_counter()
+            page = await _fetch_json(http, method, href, body)
+            self._page_done(start, page)
+
+            link = next((l for l in page.get("links", []) if l.get("rel") == "next"), None)
+            if link is None:
+                break
+            method, href = link.get("method", "GET").upper(), link["href"]
+            if method == "POST":
+                body = {**body, **link.get("body", {})} if link.get("merge") else link.get("body", body)
+
+    def _add(self, features):
+        super()._add(features)
+        if self.first_page.is_set():
+            self._first_page_async.set()
+
+    def _finished(self, future):
+        super()._finished(future)
+        if self.done.is_set():
+            self._first_page_async.set()
+
+    async def wait_first_page(self, timeout=FIRST_PAGE_TIMEOUT):
+        """Async variant of first_page_result"""
+
+        try:
+            await asyncio.wait_for(self._first_page_async.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.cancel()
+            raise TimeoutError(f"STAC search returned no page within {timeout}s") from None
+        self._check_first_page()
+        return self.feature_collection()
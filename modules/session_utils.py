@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import panel as pn
+from langchain.agents import initialize_agent, AgentType
+from langchain.prompts import MessagesPlaceholder
+from modules.chat_utils import MapManager, build_tools
+from modules.memory_utils import BudgetedMemory
+from modules.trace_callbacks import TraceCallbackHandler
+from modules.trace_utils import (
+    Tracer,
+    register_session_tracer,
+    unregister_session_tracer,
+    span,
+)
+
+# Shared by all sessions: at most this many agent runs execute at once
+MAX_CONCURRENT_RUNS = 8
+_RUN_SLOTS = {}
+
+
+def _run_slots():
+    """Semaphore bounding the agent runs of the running event loop"""
+
+    loop = asyncio.get_running_loop()
+    slots = _RUN_SLOTS.get(loop)
+    if slots is None:
+        slots = _RUN_SLOTS[loop] = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+    return slots
+
+
+class SessionBusy(Exception):
+    """Raised when a session already has too many messages queued"""
+
+
+class Session:
+    """
+    State of one browser session: its own MapManager, tools, memory and agent.
+    Messages of a session run one at a time, in order, on the event loop
+    (agent.arun + async tools), so no thread is held while waiting on the network.
+    """
+
+    def __init__(self, llm, max_pending=3, memory_tokens=1000):
+        self.tracer = Tracer("session")
+        self.map_mgr = MapManager()
+        self.tools = build_tools(self.map_mgr)
+        # Recent turns verbatim, older ones summarized, so prompts stop growing
+        self.memory = BudgetedMemory(
+            llm=llm,
+            map_mgr=self.map_mgr,
+            memory_key="memory",
+            return_messages=True,
+            max_token_limit=memory_tokens,
+        )
+
+        agent_kwargs = {
+            "extra_prompt_messages": [MessagesPlaceholder(variable_name="memory")],
+        }
+        self.agent = initialize_agent(
+            self.tools,
+            llm,
+            agent=AgentType.OPENAI_FUNCTIONS,
+            verbose=False,  # see self.tracer
+            agent_kwargs=agent_kwargs,
+            memory=self.memory,
+        )
+
+        self.max_pending = max_pending
+        self.outstanding = 0  # queued + running messages
+        self._turn = asyncio.Lock()  # FIFO, i.e. the per-session queue
+        self._tasks = set()
+
+    async def run(self, message):
+        """
+        Run message through the agent once the session's earlier messages are done.
+        Returns (text, media); raises SessionBusy if too many messages are queued.
+        """
+
+        if self.outstanding > self.max_pending:
+            raise SessionBusy()
+
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.outstanding += 1
+        try:
+            with self.tracer.activate():
+                # Held until the tools' worker threads have returned, even when cancelled
+                async with self._turn:
+                    self.map_mgr._cancelled.clear()
+                    async with _run_slots():
+                        with span("agent.run"):
+                            text = await self.agent.arun(
+                                input=message, callbacks=[TraceCallbackHandler(self.tracer)]
+                            )
+                        # Summarize turns over the memory budget before the next message runs
+                        with span("memory.prune"):
+                            await self.memory.aprune()
+            media = self.map_mgr.media
+            self.map_mgr.media = None
+            return text, media
+        finally:
+            self.outstanding -= 1
+            self._tasks.discard(task)
+
+    def cancel(self):
+        """Cancel the running and queued messages (and any search still streaming)"""
+
+        self.map_mgr.cancel()
+        for task in list(self._tasks):
+            task.cancel()
+
+
+class SessionManager:
+    """Creates one Session per Panel/Bokeh session and drops it when the session is destroyed"""
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, llm):
+        """Session of the current document, created with llm on first use"""
+
+        session_id = pn.state.curdoc.session_context.id
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(llm)
+                register_session_tracer(session_id, session.tracer)
+                pn.state.on_session_destroyed(self._destroyed)
+        return session
+
+    def _destroyed(self, session_context):
+        with self._lock:
+            session = self._sessions.pop(session_context.id, None)
+        unregister_session_tracer(session_context.id)
+        if session is not None:
+            session.cancel()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+# Shared by all sessions (app.py runs once per session)
+SESSIONS = SessionManager()
@@ -1,5 +1,8 @@
+from functools import lru_cache
+import numpy as np
 import spyndex
 import panel as pn
+import xarray as xr
 
 BAND_MAPPING = {
     "sentinel-2-l2a": {
@@ -37,6 +40,19 @@ SPYNDEX_CONSTANTS = spyndex.constants
 # Spectral indices
 SPYNDEX_INDICES = spyndex.indices
 
+# Functions available to the compiled formulas (all elementwise, dask/xarray friendly)
+KERNEL_GLOBALS = {
+    "__builtins__": {},
+    "abs": np.abs,
+    "exp": np.exp,
+    "log": np.log,
+    "sqrt": np.sqrt,
+    "sin": np.sin,
+    "cos": np.cos,
+    "tan": np.tan,
+    "arctan": np.arctan,
+}
+
 
 def to_stac_bands(spindex, collection):
     """
@@ -107,6 +123,23 @@ def get_index_props(spindex, collection):
     }
 
 
+@lru_cache(maxsize=None)
+def compile_index(spindex):
+    """
+    Compile the spyndex formula of an index once into a vectorized kernel,
+    called with the bands/constants as keyword arguments
+    """
+
+    formula = SPYNDEX_INDICES[spindex].formula
+    code = compile(formula, f"<{spindex}>", "eval")
+
+    def kernel(**params):
+        return eval(code, KERNEL_GLOBALS, params)
+
+    kernel.__name__ = spindex
+    return kernel
+
+
 def compute_index(in_data, spindex_props):
     """
     Calculate the selected spectral index given a list of params (bands, constants).
@@ -119,12 +152,35 @@ def compute_index(in_data, spindex_props):
     constants = spindex_props["constants"]
 
     for idx, index_band in enumerate(index_bands):
-        out_params[index_band] = in_data.sel(band=stac_bands[idx])
+        out_params[index_band] = in_data.sel(band=stac_bands[idx]).drop_vars("band")
 
     if constants:
         out_params.update(constants)
 
-    return spyndex.computeIndex(index=[index_name], params=out_params)
+    return compile_index(index_name)(**out_params)
+
+
+def compute_indices(in_data, spindices, collection):
+    """
+    Calculate many spectral indices at once as an xarray.Dataset.
+    The bands are selected once and shared, so computing the (dask-backed)
+    Dataset evaluates every index in a single chunk-parallel pass.
+    """
+
+    bands = {}
+    for spindex in spindices:
+        for index_band in get_index_bands(spindex):
+            if index_band not in bands:
+                stac_band = BAND_MAPPING[collection][index_band]
+                bands[index_band] = in_data.sel(band=stac_band).drop_vars("band")
+
+    out_data = {}
+    for spindex in spindices:
+        params = {b: bands[b] for b in get_index_bands(spindex)}
+        params.update(get_index_constants(spindex) or [])
+        out_data[spindex] = compile_index(spindex)(**params)
+
+    return xr.Dataset(out_data)
 
 
 def get_index_metadata(spindex):
@@ -0,0 +1,323 @@
+"""
+In-process XYZ tile endpoint for the images of a search:
+
+    /tiles/{item-set}/{date}/{composite-or-index}/{z}/{x}/{y}.png?clip=2.5,97.5&mask=0&composite=None&days=10&cmap=RdYlGn
+
+Load with `panel serve app.py --plugins modules.tile_server`
+(or `pn.serve(..., extra_patterns=ROUTES)`).
+"""
+
+import asyncio
+import io
+import math
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from functools import lru_cache
+from urllib.parse import urlencode
+import numpy as np
+import holoviews as hv
+from matplotlib.colors import to_rgba_array
+from odc.geo.geobox import GeoBox
+from PIL import Image
+from tornado.web import HTTPError, RequestHandler
+from modules.cache_utils import ARRAY_CACHE
+from modules.image_processing import COMPOSITE_METHODS
+from modules.image_statistics import get_sketch
+from modules.loader_utils import EARTH_RADIUS, bbox_from_3857
+from modules.trace_utils import count, span, submit
+
+TILE_SIZE = 256
+MAX_COMPOSITE_DAYS = 90  # same bound as MapManager.composite_days
+
+# Shared by all sessions, tiles render here
+TILE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tile-render")
+
+_SOURCES = OrderedDict()
+_SOURCES_LOCK = threading.Lock()
+MAX_SOURCES = 64
+
+
+class TileSource:
+    """
+    A viewer's layers: layer_fn(day, layer, **selection) returns the in-memory
+    (ARRAY_CACHE) EPSG:3857 overview of a date and composite or index, read from the
+    viewer's persisted cube at resolution, and bbox is the search bbox.
+    tile_fn(day, layer, bbox, geobox, **selection) returns the layer on a tile's own
+    grid (or None to use the overview), for tiles finer than the overview.
+    layers lists the composites/indices that can be requested (any if None).
+    """
+
+    def __init__(self, layer_fn, bbox, resolution=None, tile_fn=None, layers=None):
+        if isinstance(bbox, str):
+            bbox = tuple(map(float, bbox.split(",")))
+        self.layer_fn = layer_fn
+        self.bbox = tuple(bbox)
+        self.resolution = resolution
+        self.tile_fn = tile_fn
+        self.layers = set(layers) if layers is not None else None
+
+
+def register_source(item_set, layer_fn, bbox, resolution=None, tile_fn=None, layers=None):
+    """Serve tiles of a viewer's layers under item_set, returns item_set"""
+
+    with _SOURCES_LOCK:
+        _SOURCES[item_set] = TileSource(layer_fn, bbox, resolution, tile_fn, layers)
+        _SOURCES.move_to_end(item_set)
+        while len(_SOURCES) > MAX_SOURCES:
+            _SOURCES.popitem(last=False)
+    return item_set
+
+
+def tile_url(item_set, day, layer, clip_range=(2.5, 97.5), mask_cl=False, composite="None", composite_days=10, cmap=None):
+    """Tile url template (with {Z}/{X}/{Y} placeholders) of a date and composite or index"""
+
+    query = {
+        "clip": ",".join(str(float(c)) for c in clip_range),
+        "mask": int(bool(mask_cl)),
+        "composite": composite,
+        "days": composite_days,
+    }
+    if cmap is not None:
+        query["cmap"] = cmap
+    return f"/tiles/{item_set}/{day.isoformat()}/{layer}/" + "{Z}/{X}/{Y}.png?" + urlencode(query)
+
+
+def tile_bounds(z, x, y):
+    """EPSG:3857 bounds (minx, miny, maxx, maxy) of an XYZ tile"""
+
+    half = math.pi * EARTH_RADIUS
+    size = 2 * half / 2**z
+    minx = -half + x * size
+    maxy = half - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def tile_array(item_set, day, layer, z, x, y, **selection):
+    """
+    Values of a layer on the 256x256 pixel centers of a tile, NaN outside of it.
+    Tiles at least half as coarse as the overview are cut from the resident overview
+    (nearest pixel); deeper zooms read only the tile's own pixels, at its resolution.
+    """
+
+    source = _SOURCES[item_set]
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    size = (maxx - minx) / TILE_SIZE
+
+    if source.tile_fn is not None and source.resolution and size < source.resolution / 2:
+        geobox = GeoBox.from_bbox((minx, miny, maxx, maxy), crs="EPSG:3857", shape=(TILE_SIZE, TILE_SIZE))
+        bbox = bbox_from_3857((minx, maxx), (miny, maxy))
+        with span("tile.load", layer=layer, z=z):
+            tile = source.tile_fn(day, layer, bbox, geobox, **selection)
+        if tile is not None:
+            return np.asarray(tile.values, dtype="float32")
+
+    data = source.layer_fn(day, layer, **selection)
+    centers = (np.arange(TILE_SIZE) + 0.5) * size
+    resolution = abs(float(data.x[1] - data.x[0])) if data.sizes["x"] > 1 else size
+
+    tile = data.reindex(x=minx + centers, y=maxy - centers, method="nearest", tolerance=resolution)
+    return tile.values.astype("float32")
+
+
+_RANGES = OrderedDict()  # key -> Future of the (vmin, vmax) value range
+_RANGES_LOCK = threading.Lock()
+MAX_RANGES = 256
+
+
+def layer_range(item_set, day, layer, clip_range, **selection):
+    """
+    Value range (clip percentiles) of a layer over the whole search bbox.
+    Every tile is stretched to it so that tiles of a layer match seamlessly.
+    Concurrent first tiles of a layer wait for a single computation.
+    """
+
+    key = (item_set, day, layer, tuple(clip_range)) + tuple(sorted(selection.items()))
+    with _RANGES_LOCK:
+        future = _RANGES.get(key)
+        owner = future is None
+        if owner:
+            future = _RANGES[key] = Future()
+            while len(_RANGES) > MAX_RANGES:
+                _RANGES.popitem(last=False)
+
+    if owner:
+        try:
+            data = _SOURCES[item_set].layer_fn(day, layer, **selection)
+            value_range = (0.0, 1.0) if layer == "RGB" else None
+            future.set_result(tuple(get_sketch(data, value_range=value_range).percentiles(clip_range)))
+        except Exception as exc:
+            with _RANGES_LOCK:
+                _RANGES.pop(key, None)
+            future.set_exception(exc)
+    return future.result()
+
+
+@lru_cache(maxsize=64)
+def colormap(cmap):
+    """RGBA (uint8) lookup table of 256 colors of a HoloViews colormap"""
+
+    colors = hv.plotting.util.process_cmap(cmap, ncolors=256)
+    return (to_rgba_array(colors) * 255).astype("uint8")
+
+
+def colorize(values, layer, value_range, cmap="RdYlGn"):
+    """RGBA image of a tile: stretched RGB, or colormapped index values within value_range"""
+
+    vmin, vmax = value_range
+    scaled = (values - vmin) / max(vmax - vmin, 1e-6)
+
+    if layer == "RGB":
+        valid = np.isfinite(values).all(axis=0)
+        rgb = (np.nan_to_num(scaled).clip(0, 1) * 255).astype("uint8")
+        rgba = np.dstack([*rgb, np.where(valid, 255, 0).astype("uint8")])
+    else:
+        # Like the clip stage, values outside the clip percentiles are not drawn
+        valid = np.isfinite(values) & (values >= vmin) & (values <= vmax)
+        rgba = colormap(cmap)[(np.nan_to_num(scaled).clip(0, 1) * 255).astype(int)]
+        rgba[..., 3] = np.where(valid, rgba[..., 3], 0)
+    return rgba
+
+
+def encode_png(rgba):
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG", optimize=False)
+    return buffer.getvalue()
+
+
+EMPTY_TILE = encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype="uint8"))
+
+
+def render_tile(item_set, day, layer, z, x, y, clip_range=(2.5, 97.5), mask_cl=False,
+                composite="None", composite_days=10, cmap="RdYlGn"):
+    """
+    PNG bytes of one 256x256 tile, transparent where there is no data.
+    The tile's values are cached without clip/colormap, so recoloring
+    only re-runs colorize on them.
+    """
+
+    source = _SOURCES[item_set]
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    bbox = bbox_from_3857((minx, maxx), (miny, maxy))
+    sx, sy, ex, ey = source.bbox
+    if bbox[2] < sx or bbox[0] > ex or bbox[3] < sy or bbox[1] > ey:
+        return EMPTY_TILE
+
+    selection = dict(mask_cl=mask_cl, composite=composite, composite_days=composite_days)
+    with span("tile.render", layer=layer, z=z, x=x, y=y):
+        key = (item_set, day, layer, z, x, y) + tuple(sorted(selection.items())) + ("tile",)
+        values = ARRAY_CACHE.get_or_compute(key, lambda: tile_array(item_set, day, layer, z, x, y, **selection))
+        value_range = layer_range(item_set, day, layer, clip_range, **selection)
+        return encode_png(colorize(values, layer, value_range, cmap))
+
+
+class TileCache:
+    """
+    LRU cache of rendered tiles (PNG bytes) bounded by max_bytes, shared by all sessions.
+    Concurrent requests for a tile that is still rendering wait for the same render.
+    """
+
+    def __init__(self, max_bytes=2**28):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, fn):
+        """concurrent.futures.Future of the tile for key, fn() renders it on TILE_POOL on a miss"""
+
+        with self._lock:
+            png = self._tiles.get(key)
+            if png is not None:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                count("cache.tile.hit")
+                future = Future()
+                future.set_result(png)
+                return future
+            future = self._rendering.get(key)
+            if future is not None:
+                self.hits += 1
+                count("cache.tile.hit")
+                return future
+            self.misses += 1
+            count("cache.tile.miss")
+            future = self._rendering[key] = submit(TILE_POOL, fn)
+        future.add_done_callback(lambda f: self._store(key, f))
+        return future
+
+    def _store(self, key, future):
+        with self._lock:
+            self._rendering.pop(key, None)
+            if future.cancelled() or future.exception() is not None:
+                return
+            png = future.result()
+            self._tiles[key] = png
+            self.nbytes += len(png)
+            while self.nbytes > self.max_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self):
+        return {"tiles": len(self._tiles), "nbytes": self.nbytes, "hits": self.hits, "misses": self.misses}
+
+
+TILE_CACHE = TileCache()
+
+
+class TileHandler(RequestHandler):
+    """GET /tiles/{item-set}/{date}/{composite-or-index}/{z}/{x}/{y}.png"""
+
+    async def get(self, item_set, day, layer, z, x, y):
+        source = _SOURCES.get(item_set)
+        if source is None:
+            raise HTTPError(404, f"unknown item set {item_set}")
+        if source.layers is not None and layer not in source.layers:
+            raise HTTPError(404, f"unknown layer {layer}")
+        composite = self.get_argument("composite", "None")
+        try:
+            day = date.fromisoformat(day)
+            clip_range = tuple(float(c) for c in self.get_argument("clip", "2.5,97.5").split(","))
+            composite_days = int(self.get_argument("days", "10"))
+            if len(clip_range) != 2:
+                raise ValueError(f"clip needs two percentiles, got {len(clip_range)}")
+            if not 1 <= composite_days <= MAX_COMPOSITE_DAYS:
+                raise ValueError(f"days must be within 1-{MAX_COMPOSITE_DAYS}")
+            if composite != "None" and composite not in COMPOSITE_METHODS:
+                raise ValueError(f"composite must be None or one of {COMPOSITE_METHODS}")
+        except ValueError as exc:
+            raise HTTPError(400, str(exc))
+
+        options = dict(
+            clip_range=clip_range,
+            mask_cl=self.get_argument("mask", "0") == "1",
+            composite=composite,
+            composite_days=composite_days,
+            cmap=self.get_argument("cmap", "RdYlGn"),
+        )
+        z, x, y = int(z), int(x), int(y)
+
+        key = (item_set, day, layer, z, x, y) + tuple(sorted(options.items()))
+        future = TILE_CACHE.get_or_render(key, lambda: render_tile(item_set, day, layer, z, x, y, **options))
+        png = await asyncio.wrap_future(future)
+
+        self.set_header("Content-Type", "image/png")
+        # Tile urls encode everything the image depends on, browsers may keep them
+        self.set_header("Cache-Control", "public, max-age=86400")
+        self.write(png)
+
+
+# Picked up by `panel serve --plugins modules.tile_server`
+ROUTES = [
+    (r"/tiles/([^/]+)/(\d{4}-\d{2}-\d{2})/([^/]+)/(\d+)/(\d+)/(\d+)\.png", TileHandler),
+]
@@ -0,0 +1,37 @@
+"""
+LangChain callbacks for the tracer, kept apart from trace_utils so that
+tracing the search/load/tile paths doesn't import langchain
+"""
+
+import time
+from langchain.callbacks.base import BaseCallbackHandler
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """LangChain callbacks recording LLM calls (with token counts) as spans of a tracer"""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self._starts = {}
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is None:
+            return
+        usage = (response.llm_output or {}).get("token_usage", {})
+        self.tracer.record("llm", start, time.perf_counter(), **usage)
+        for key in ["prompt_tokens", "completion_tokens", "total_tokens"]:
+            if key in usage:
+                self.tracer.count(f"llm.{key}", usage[key])
+        self.tracer.count("llm.calls")
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            self.tracer.record("llm", start, time.perf_counter(), error=type(error).__name__)
@@ -0,0 +1,233 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# Tracer and span of the running code, copied into asyncio tasks and asyncio.to_thread
+_TRACER = contextvars.ContextVar("satgpt_tracer", default=None)
+_SPAN = contextvars.ContextVar("satgpt_span", default=None)
+
+# Tracers of the Panel sessions, for callbacks that run outside the chat's context
+_SESSION_TRACERS = {}
+
+_PID = os.getpid()
+
+
+class Span:
+    """A timed unit of work: name, start/end (perf_counter seconds), parent span and attributes"""
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.thread = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+
+class Tracer:
+    """
+    Collects the spans (at most max_spans, oldest dropped) and counters
+    (cache hits, bytes read, LLM tokens, ...) of one session
+    """
+
+    def __init__(self, name="satgpt", max_spans=10000):
+        self.name = name
+        self.spans = deque(maxlen=max_spans)
+        self.counters = Counter()
+        self._lock = threading.Lock()
+        # perf_counter -> epoch microseconds, for exporters
+        self._epoch = time.time() - time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time the enclosed block as a child of the current span"""
+
+        span = Span(name, parent=_SPAN.get(), **attrs)
+        token = _SPAN.set(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.attrs["error"] = type(exc).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            _SPAN.reset(token)
+            with self._lock:
+                self.spans.append(span)
+
+    def record(self, name, start, end, **attrs):
+        """Add a span timed elsewhere (e.g. from callbacks)"""
+
+        span = Span(name, parent=_SPAN.get(), **attrs)
+        span.start, span.end = start, end
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    @contextmanager
+    def activate(self):
+        """Make this the tracer of the enclosed code (and of the tasks/threads it starts)"""
+
+        token = _TRACER.set(self)
+        try:
+            yield self
+        finally:
+            _TRACER.reset(token)
+
+    def summary(self):
+        """Per span name: count, total, mean and max duration (s), slowest first"""
+
+        stats = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span.end is None:
+                continue
+            s = stats.setdefault(span.name, {"name": span.name, "count": 0, "total_s": 0.0, "max_s": 0.0})
+            s["count"] += 1
+            s["total_s"] += span.duration
+            s["max_s"] = max(s["max_s"], span.duration)
+        for s in stats.values():
+            s["mean_s"] = s["total_s"] / s["count"]
+        return sorted(stats.values(), key=lambda s: s["total_s"], reverse=True)
+
+    def to_chrome_trace(self):
+        """
+        Spans and counters in the Chrome trace event format
+        (chrome://tracing, https://ui.perfetto.dev)
+        """
+
+        with self._lock:
+            spans = list(self.spans)
+            counters = dict(self.counters)
+
+        events = [
+            {
+                "name": span.name,
+                "cat": span.name.split(".")[0],
+                "ph": "X",
+                "ts": (self._epoch + span.start) * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": _PID,
+                "tid": span.thread,
+                "args": {k: v if isinstance(v, (int, float, bool)) else str(v) for k, v in span.attrs.items()},
+            }
+            for span in spans
+            if span.end is not None
+        ]
+        events.append(
+            {"name": "counters", "ph": "C", "ts": time.time() * 1e6, "pid": _PID, "args": counters}
+        )
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"tracer": self.name}}
+
+    def export(self, path):
+        """Write the Chrome trace JSON to path"""
+
+        with open(path, "w") as f:
+            json.dump(self.to_chrome_trace(), f)
+        return path
+
+
+# Work that belongs to no session (shared pools, tile server)
+GLOBAL_TRACER = Tracer("global")
+
+
+def register_session_tracer(session_id, tracer):
+    _SESSION_TRACERS[session_id] = tracer
+
+
+def unregister_session_tracer(session_id):
+    _SESSION_TRACERS.pop(session_id, None)
+
+
+def current_tracer():
+    """Tracer of the running chat turn, else of the current Panel session, else the global one"""
+
+    tracer = _TRACER.get()
+    if tracer is not None:
+        return tracer
+    if _SESSION_TRACERS:
+        import panel as pn
+
+        doc = pn.state.curdoc
+        context = getattr(doc, "session_context", None) if doc is not None else None
+        tracer = _SESSION_TRACERS.get(getattr(context, "id", None))
+        if tracer is not None:
+            return tracer
+    return GLOBAL_TRACER
+
+
+def span(name, **attrs):
+    """Context manager timing the enclosed block on the current tracer"""
+
+    return current_tracer().span(name, **attrs)
+
+
+def count(name, value=1):
+    """Add value to a counter of the current tracer"""
+
+    current_tracer().count(name, value)
+
+
+def traced(name):
+    """Decorator timing every call of a function (or coroutine function) as a span"""
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with span(name):
+                    return fn(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def submit(pool, fn, *args, **kwargs):
+    """pool.submit that keeps the current tracer/span in the worker thread"""
+
+    return pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def diagnostics_panel(tracer, period=2000):
+    """Small Panel view of a tracer: slowest spans, counters and a Chrome trace download"""
+
+    import io
+    import pandas as pd
+    import panel as pn
+
+    spans = pn.pane.DataFrame(pd.DataFrame(), sizing_mode="stretch_width", float_format="{:.3f}".format)
+    counters = pn.pane.DataFrame(pd.DataFrame(), sizing_mode="stretch_width")
+
+    def refresh():
+        spans.object = pd.DataFrame(tracer.summary()[:15], columns=["name", "count", "total_s", "mean_s", "max_s"])
+        counters.object = pd.DataFrame(sorted(tracer.counters.items()), columns=["counter", "value"])
+
+    def trace_file():
+        return io.StringIO(json.dumps(tracer.to_chrome_trace()))
+
+    download = pn.widgets.FileDownload(
+        callback=trace_file, filename="satgpt-trace.json", label="Download trace (Chrome/Perfetto)"
+    )
+    refresh()
+    pn.state.add_periodic_callback(refresh, period=period)
+    return pn.Column(spans, counters, download)
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("tornado")
+
+from modules.basemap_proxy import BasemapProxy, DiskTileCache, bbox_tiles
+
+TILE = b"\x89PNG stand-in tile"
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """Upstream tile server stand-in: any path is a tile except */404/*, requests are counted"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests[self.path] += 1
+        time.sleep(self.server.delay)
+        if "/404/" in self.path:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(TILE)))
+        self.end_headers()
+        self.wfile.write(TILE)
+
+
+@pytest.fixture
+def upstream():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TileHandler)
+    server.daemon_threads = True
+    server.requests = Counter()
+    server.delay = 0
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    server.templates = {
+        "osm": url + "/osm/{z}/{x}/{y}.png",
+        "gibs": url + "/gibs/{layer}/{time}/{z}/{y}/{x}.jpg",
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def proxy(upstream, tmp_path):
+    return BasemapProxy(upstream.templates, cache=DiskTileCache(str(tmp_path / "tiles")))
+
+
+def test_fetches_once_then_serves_from_disk(proxy, upstream):
+    assert proxy.get("osm", 3, 1, 2).result(timeout=10) == TILE
+    assert proxy.get("osm", 3, 1, 2).result(timeout=10) == TILE
+    assert upstream.requests["/osm/3/1/2.png"] == 1
+    assert (proxy.hits, proxy.misses) == (1, 1)
+
+    # A new proxy over the same directory (e.g. after a restart) still has it
+    restarted = BasemapProxy(upstream.templates, cache=DiskTileCache(proxy.cache.cache_dir), offline=True)
+    assert restarted.get("osm", 3, 1, 2).result(timeout=10) == TILE
+
+
+def test_concurrent_requests_share_one_fetch(proxy, upstream):
+    upstream.delay = 0.2
+    futures = [proxy.get("osm", 4, 3, 5) for _ in range(5)]
+    assert all(f.result(timeout=10) == TILE for f in futures)
+    assert upstream.requests["/osm/4/3/5.png"] == 1
+
+
+def test_params_and_missing_tiles(proxy, upstream):
+    params = proxy.check_params("gibs", {"layer": "MODIS_Aqua", "time": "2023-06-09", "extra": "x"})
+    assert params == {"layer": "MODIS_Aqua", "time": "2023-06-09"}
+    assert proxy.get("gibs", 2, 1, 3, **params).result(timeout=10) == TILE
+    assert upstream.requests["/gibs/MODIS_Aqua/2023-06-09/2/3/1.jpg"] == 1
+
+    with pytest.raises(ValueError):
+        proxy.check_params("gibs", {"layer": "MODIS_Aqua"})
+    with pytest.raises(ValueError):
+        proxy.check_params("gibs", {"layer": "../../etc", "time": "2023-06-09"})
+
+    assert proxy.get("osm", 404, 0, 0).result(timeout=10) is None
+
+
+def test_offline_serves_only_cached_tiles(upstream, tmp_path):
+    proxy = BasemapProxy(upstream.templates, cache=DiskTileCache(str(tmp_path / "tiles")), offline=True)
+    assert proxy.get("osm", 1, 0, 0).result(timeout=10) is None
+    assert proxy.prefetch("osm", (-10.0, -10.0, 10.0, 10.0)) == []
+    assert not upstream.requests
+
+
+def test_prefetch(proxy, upstream):
+    bbox = (-122.4, 47.5, -122.2, 47.7)
+    futures = proxy.prefetch("osm", bbox, zoom=10, depth=0)
+    assert len(futures) == len(bbox_tiles(bbox, 10))
+    assert all(f.result(timeout=10) == TILE for f in futures)
+    # Cached tiles are not fetched again
+    assert proxy.prefetch("osm", bbox, zoom=10, depth=0) == []
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskTileCache(str(tmp_path / "tiles"), max_bytes=2 * len(TILE))
+    cache.set("a.png", TILE)
+    cache.set("b.png", TILE)
+    assert cache.get("a.png") == TILE
+    cache.set("c.png", TILE)
+
+    assert "b.png" not in cache
+    assert "a.png" in cache and "c.png" in cache
+    assert cache.nbytes == 2 * len(TILE)
@@ -0,0 +1,45 @@
+import json
+from modules.cache_utils import StacSearchCache, normalize_search_key
+
+URL = "https://earth-search.aws.element84.com/v1/"
+
+
+def result(n):
+    features = [{"id": f"item-{i}", "properties": {"datetime": "2023-06-01T19:00:00Z"}} for i in range(n)]
+    return {"count": n, "items": {"type": "FeatureCollection", "features": features}}
+
+
+def key(day):
+    return normalize_search_key(URL, "sentinel-2-l2a", "-122.4,47.5,-122.2,47.7", f"2023-06-{day:02d}")
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = StacSearchCache(cache_dir=str(tmp_path))
+    cache.set(key(1), result(3))
+
+    restarted = StacSearchCache(cache_dir=str(tmp_path))
+    assert restarted.get(key(1)) == result(3)
+    assert restarted.disk_hits == 1
+    assert restarted.get(key(2)) is None
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    entry_bytes = len(json.dumps({"created": 0.0, "key": key(1), "value": result(50)}))
+    cache = StacSearchCache(max_items=1, cache_dir=str(tmp_path), max_bytes=3 * entry_bytes)
+    for day in range(1, 11):
+        cache.set(key(day), result(50))
+
+    files = list(tmp_path.iterdir())
+    assert len(files) <= 3
+    assert sum(f.stat().st_size for f in files) <= 3 * entry_bytes
+    # Oldest searches were evicted, the latest is still on disk
+    restarted = StacSearchCache(cache_dir=str(tmp_path))
+    assert restarted.get(key(1)) is None
+    assert restarted.get(key(10)) == result(50)
+
+
+def test_expired_entries_are_removed(tmp_path):
+    cache = StacSearchCache(ttl=-1, cache_dir=str(tmp_path))
+    cache.set(key(1), result(1))
+    assert cache.get(key(1)) is None
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,74 @@
+import pytest
+
+langchain = pytest.importorskip("langchain")
+
+from langchain.chat_models.base import BaseChatModel
+from langchain.schema import AIMessage, ChatGeneration, ChatResult, HumanMessage, SystemMessage
+from modules import llm_cache
+from modules.llm_cache import SatGPTLLMCache
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model answering with a fixed message (or failing), counting its calls"""
+
+    content: str = "Done!"
+    function_call: dict = None
+    fail: bool = False
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("model unavailable")
+        extra = {"function_call": self.function_call} if self.function_call else {}
+        message = AIMessage(content=self.content, additional_kwargs=extra)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = SatGPTLLMCache(path=str(tmp_path / "llm_cache.sqlite"))
+    monkeypatch.setattr(langchain, "llm_cache", cache)
+    return cache
+
+
+def ask(model, text):
+    return model([SystemMessage(content="You are SatGPT."), HumanMessage(content=text)])
+
+
+def test_exact_hit(cache):
+    model = FakeChatModel()
+
+    assert ask(model, "Show the images").content == "Done!"
+    assert ask(model, "Show the images").content == "Done!"
+    assert model.calls == 1
+    assert (cache.hits, cache.misses, cache.llm_calls) == (1, 1, 1)
+    assert not cache._missed_at
+
+
+def test_normalized_hit_replays_function_calls_only(cache):
+    planner = FakeChatModel(function_call={"name": "show_datacube", "arguments": "{}"})
+    ask(planner, "Show the images!")
+    ask(planner, "  show the IMAGES ")
+    assert planner.calls == 1
+    assert cache.normalized_hits == 1
+
+    answerer = FakeChatModel(content="Plotted!")
+    ask(answerer, "Plot the cloud cover")
+    ask(answerer, "plot the cloud cover!")
+    assert answerer.calls == 2
+
+
+def test_failed_calls_do_not_leak(cache, monkeypatch):
+    monkeypatch.setattr(llm_cache, "MAX_PENDING_MISSES", 4)
+    model = FakeChatModel(fail=True)
+
+    for i in range(10):
+        with pytest.raises(RuntimeError):
+            ask(model, f"question {i}")
+    assert model.calls == 10
+    assert len(cache._missed_at) == 4
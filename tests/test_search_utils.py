@@ -0,0 +1,168 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+pytest.importorskip("pystac_client")
+pytest.importorskip("aiohttp")
+
+from modules.search_utils import AsyncStreamingSearch, StreamingSearch
+
+BBOX = "-122.4,47.5,-122.2,47.7"
+DTIME = "2023-06-01/2023-06-10"
+PAGE_SIZE = 2
+FEATURES = [
+    {
+        "type": "Feature",
+        "stac_version": "1.0.0",
+        "id": f"item-{i}",
+        "geometry": None,
+        "properties": {"datetime": f"2023-06-{i + 1:02d}T19:00:00Z"},
+        "links": [],
+        "assets": {},
+    }
+    for i in range(5)
+]
+
+
+class StacHandler(BaseHTTPRequestHandler):
+    """Minimal STAC API: a landing page and a paged POST /search (mode set on the server)"""
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        root = self.server.url
+        self._send(200, {
+            "type": "Catalog",
+            "stac_version": "1.0.0",
+            "id": "stand-in",
+            "description": "Local STAC API stand-in",
+            "conformsTo": [
+                "https://api.stacspec.org/v1.0.0/core",
+                "https://api.stacspec.org/v1.0.0/item-search",
+            ],
+            "links": [
+                {"rel": "self", "href": root, "type": "application/json"},
+                {"rel": "root", "href": root, "type": "application/json"},
+                {"rel": "search", "href": f"{root}search", "type": "application/geo+json", "method": "GET"},
+                {"rel": "search", "href": f"{root}search", "type": "application/geo+json", "method": "POST"},
+            ],
+        })
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+        # limit=1 is the match count request, the others are sub-query pages
+        if body.get("limit") != 1:
+            if self.server.mode == "fail":
+                return self._send(500, {"code": "ServerError", "description": "boom"})
+            if self.server.mode == "slow":
+                time.sleep(2)
+            if self.server.mode == "one_empty":
+                # The May sub-query has nothing, June's arrives later
+                if str(body.get("datetime", "")).startswith("2023-05"):
+                    return self._send(200, {"type": "FeatureCollection", "features": [], "links": []})
+                time.sleep(0.3)
+
+        token = int(body.get("token", 0))
+        limit = int(body.get("limit", PAGE_SIZE))
+        page = {
+            "type": "FeatureCollection",
+            "features": FEATURES[token:token + limit],
+            "numberMatched": len(FEATURES),
+            "links": [],
+        }
+        if token + limit < len(FEATURES) and limit != 1:
+            page["links"].append({
+                "rel": "next",
+                "href": f"{self.server.url}search",
+                "method": "POST",
+                "body": {"token": token + limit},
+                "merge": True,
+            })
+        self._send(200, page)
+
+
+@pytest.fixture
+def stac_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StacHandler)
+    server.daemon_threads = True
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    server.mode = "ok"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_streams_pages(stac_api):
+    pages = []
+    search = StreamingSearch(stac_api.url, "sentinel-2-l2a", BBOX, DTIME, page_size=PAGE_SIZE, on_page=pages.append)
+    search.start()
+
+    assert search.first_page_result()["features"]
+    items = search.wait(timeout=10)
+    assert search.count == len(FEATURES)
+    assert sorted(f["id"] for f in items["features"]) == sorted(f["id"] for f in FEATURES)
+    assert sum(len(p) for p in pages) == len(FEATURES)
+
+
+def test_failed_search_raises(stac_api):
+    stac_api.mode = "fail"
+    done = []
+    search = StreamingSearch(stac_api.url, "sentinel-2-l2a", BBOX, DTIME, page_size=PAGE_SIZE, on_done=done.append)
+    search.start()
+
+    with pytest.raises(Exception):
+        search.first_page_result()
+    assert search.errors
+    assert not done  # failed searches are not cached
+
+
+def test_first_page_timeout(stac_api):
+    stac_api.mode = "slow"
+    search = StreamingSearch(stac_api.url, "sentinel-2-l2a", BBOX, DTIME, page_size=PAGE_SIZE)
+    search.start()
+
+    with pytest.raises(TimeoutError):
+        search.first_page_result(timeout=0.2)
+
+
+def test_empty_subquery_is_not_a_first_page(stac_api):
+    stac_api.mode = "one_empty"
+    # Split into a May and a June sub-query
+    search = StreamingSearch(stac_api.url, "sentinel-2-l2a", BBOX, "2023-05-01/2023-06-10", page_size=PAGE_SIZE)
+    search.start()
+
+    assert search.first_page_result(timeout=10)["features"]
+
+
+def test_async_search(stac_api):
+    async def run(mode):
+        stac_api.mode = mode
+        search = AsyncStreamingSearch(stac_api.url, "sentinel-2-l2a", BBOX, DTIME, page_size=PAGE_SIZE)
+        await search.start()
+        first = await search.wait_first_page(timeout=0.2 if mode == "slow" else 10)
+        while mode == "ok" and not search.done.is_set():
+            await asyncio.sleep(0.01)
+        return search, first
+
+    search, first = asyncio.run(run("ok"))
+    assert first["features"]
+    assert len(search.feature_collection()["features"]) == len(FEATURES)
+
+    with pytest.raises(Exception):
+        asyncio.run(run("fail"))
+    with pytest.raises(TimeoutError):
+        asyncio.run(run("slow"))